@@ -1,5 +1,6 @@
 import argparse
 import nrresqml
+from nrresqml.derivatives.opendap import RemoteReadOptions
 from time import perf_counter
 
 
@@ -10,9 +11,61 @@ parser.add_argument(
 parser.add_argument(
     'resqml_directory', metavar='<resqml_directory>', help='Destination directory for the ResQml output'
 )
+parser.add_argument(
+    '--buffer-size', metavar='<MiB>', type=int, default=None,
+    help='Stream data sets to the output file in slabs of at most this many MiB, keeping memory usage bounded'
+)
+parser.add_argument(
+    '--compression-level', metavar='<0-9>', type=int, choices=range(10), default=None,
+    help='gzip compression level of the property data sets written to the output file'
+)
+parser.add_argument(
+    '--pillar-storage', choices=('split', 'virtual'), default='split',
+    help='Store four copies of each grid pillar (split), or a single copy exposed as four virtual copies (virtual)'
+)
+parser.add_argument(
+    '--lattice-control-points', action='store_true',
+    help='Represent the lateral grid geometry as a lattice if the grid is regular'
+)
+parser.add_argument(
+    '--workers', metavar='<n>', type=int, default=None,
+    help='Number of worker processes used to process data sets and serialize ResQml objects in parallel'
+)
+parser.add_argument(
+    '--link-source-data', action='store_true',
+    help='Refer the data sets of the (local) Delft3D file through HDF5 external links instead of copying them'
+)
+parser.add_argument(
+    '--connections', metavar='<n>', type=int, default=RemoteReadOptions.connections,
+    help='Maximum number of concurrent requests when reading from an OpenDAP server'
+)
+parser.add_argument(
+    '--cache-dir', metavar='<directory>', default=None,
+    help='Cache data fetched from an OpenDAP server in this directory, so that it is not downloaded again'
+)
+parser.add_argument(
+    '--cache-size', metavar='<MiB>', type=int, default=RemoteReadOptions.cache_bytes // 2 ** 20,
+    help='Maximum size of the OpenDAP cache. The least recently used data is evicted first'
+)
 
-args = parser.parse_args()
-t0 = perf_counter()
-nrresqml.convert_delft3d_to_resqml(args.delft3d_file, args.resqml_directory)
-t1 = perf_counter()
-print(f'Conversion completed in {t1 - t0} s')
+# Worker processes may import this module, in which case the conversion should not be started
+if __name__ == '__main__':
+    args = parser.parse_args()
+    buffer_bytes = None if args.buffer_size is None else args.buffer_size * 2 ** 20
+    remote_options = RemoteReadOptions(
+        connections=args.connections, cache_dir=args.cache_dir, cache_bytes=args.cache_size * 2 ** 20
+    )
+    t0 = perf_counter()
+    nrresqml.convert_delft3d_to_resqml(
+        args.delft3d_file,
+        args.resqml_directory,
+        buffer_bytes=buffer_bytes,
+        compression_level=args.compression_level,
+        pillar_storage=args.pillar_storage,
+        lattice_control_points=args.lattice_control_points,
+        workers=args.workers,
+        link_source_data=args.link_source_data,
+        remote_options=remote_options,
+    )
+    t1 = perf_counter()
+    print(f'Conversion completed in {t1 - t0} s')
@@ -1,9 +1,11 @@
 import sys
 import os
 import pathlib
+from typing import Optional
 
 from nrresqml.derivatives.hdf5resqmladaptor import Delft3DResQmlAdaptor, AdaptorError
 from nrresqml.derivatives import rqbuilder as rio
+from nrresqml.derivatives.opendap import RemoteReadOptions
 
 
 def _derive_archel_name(delft3d_name: str):
@@ -24,7 +26,12 @@ def _derive_archel_name(delft3d_name: str):
             return delft3d_name
 
 
-def convert_delft3d_to_resqml(delft3d_file_name: str, resqml_output_directory: str) -> None:
+def convert_delft3d_to_resqml(delft3d_file_name: str, resqml_output_directory: str,
+                              buffer_bytes: Optional[int] = None, compression_level: Optional[int] = None,
+                              pillar_storage: str = 'split',
+                              lattice_control_points: bool = False, workers: Optional[int] = None,
+                              link_source_data: bool = False,
+                              remote_options: Optional[RemoteReadOptions] = None) -> None:
     """
     Converts an existing Delft3D NetCdf file to a ResQml file(s)
 
@@ -35,6 +42,25 @@ def convert_delft3d_to_resqml(delft3d_file_name: str, resqml_output_directory: s
                                         - resqml_output_directory/<resqml_file_name>.epc
                                         - resqml_output_directory/<resqml_file_name>.h5
                                      The base name 'resqml_file_name' is derived from delft3d_file_name
+    :param buffer_bytes:            Data sets are streamed to the output file in slabs of at most buffer_bytes bytes,
+                                    which keeps the memory usage bounded regardless of the size of the input. A default
+                                    budget is used if None
+    :param compression_level:       gzip compression level (0-9) of the property data sets written to the .h5 file.
+                                    The h5py default is used if None
+    :param pillar_storage:          Storage format of the grid pillars. 'split' stores four copies of each pillar,
+                                    'virtual' stores each pillar once and exposes the four split pillars through an
+                                    HDF5 virtual data set
+    :param lattice_control_points:  If True, the lateral grid geometry is represented as a lattice when the grid is
+                                    regular, instead of storing explicit control points
+    :param workers:                 Number of worker processes used to process data sets, and to serialize the ResQml
+                                    objects, in parallel. None or 1 means that everything is processed sequentially by
+                                    the calling process
+    :param link_source_data:        If True, the .h5 file refers the data sets of the Delft3D file(s) through HDF5
+                                    external links instead of copying them. Only the grid geometry is written. The
+                                    Delft3D file(s) must be local, and must be kept in place for the output to be valid
+    :param remote_options:          Options for reading from an OpenDAP server when delft3d_file_name is a url, such as
+                                    the number of concurrent connections and the location and size of the local slab
+                                    cache. Defaults are used if None
     """
     try:
         # Derive name of file containing architectural elements from the base name
@@ -42,10 +68,17 @@ def convert_delft3d_to_resqml(delft3d_file_name: str, resqml_output_directory: s
         daf = Delft3DResQmlAdaptor(
             delft3d_file_name,
             archel_file,
+            buffer_bytes=buffer_bytes,
+            compression_level=compression_level,
+            pillar_storage=pillar_storage,
+            lattice_control_points=lattice_control_points,
+            workers=workers,
+            link_source_data=link_source_data,
+            remote_options=remote_options,
         )
     except AdaptorError as e:
         print('Failed to create ResQml database:')
         print(e)
         sys.exit(1)
     save_path = pathlib.Path(resqml_output_directory) / pathlib.Path(delft3d_file_name).with_suffix('.epc').name
-    rio.build_from_adaptor(daf, save_path, True)
+    rio.build_from_adaptor(daf, save_path, True, workers=workers)
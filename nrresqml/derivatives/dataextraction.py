@@ -1,26 +1,25 @@
 import numpy as np
 import h5py
-from typing import Optional
+from dataclasses import dataclass
+from typing import Optional, Tuple, Union, Dict, Sequence, Iterator
 
+from nrresqml.derivatives import h5streaming
+from nrresqml.derivatives.h5arrayview import Hdf5ArrayView
+from nrresqml.derivatives.ijkgridcreator import SPLIT_PILLAR_CORNERS
 from nrresqml.resqml import ResQml
 from nrresqml.structures.energetics import Hdf5Dataset
 from nrresqml.structures.resqml.geometry import IntegerHdf5Array, DoubleHdf5Array, Point3dParametricArray, \
-    ParametricLineArray, Point3dHdf5Array
+    ParametricLineArray, Point3dHdf5Array, Point3dLatticeArray, DoubleConstantArray
 from nrresqml.structures.resqml.properties import CategoricalProperty, ContinuousProperty
 from nrresqml.structures.resqml.representations import AbstractRepresentation, IjkGridRepresentation, IjkGridGeometry
 
 
-def crop_array(arr_zxy,
-               array_x0,
-               array_y0,
-               array_dx,
-               array_dy,
-               crop_x0,
-               crop_y0,
-               crop_x1,
-               crop_y1):
+def crop_indices(nx: int, ny: int, array_x0, array_y0, array_dx, array_dy, crop_x0, crop_y0, crop_x1, crop_y1
+                 ) -> Tuple[slice, slice]:
+    """
+    Index slices along the I and J axes of an (nx, ny) array, selecting the cells within the crop box. See crop_array
+    """
     assert crop_x1 > crop_x0 and crop_y1 > crop_y0
-    nx, ny = arr_zxy.shape[1:]
     # Determine crop indexes
     i0 = np.ceil((crop_x0 - array_x0) / array_dx)
     j0 = np.ceil((crop_y0 - array_y0) / array_dy)
@@ -31,42 +30,243 @@ def crop_array(arr_zxy,
     i1 = int(min(nx, i1))
     j1 = int(min(ny, j1))
     assert j1 > j0 and i1 > i0  # Verify that the crop box is properly specified
-    return arr_zxy[:, i0:i1, j0:j1]
+    return slice(i0, i1), slice(j0, j1)
 
 
-def extract_geometry(rq: ResQml, flatten_pillars: bool, indexing: str):
-    assert indexing in ('ijk', 'kij')
-    # Extract pillars and other grid parameters
+def crop_array(arr_zxy,
+               array_x0,
+               array_y0,
+               array_dx,
+               array_dy,
+               crop_x0,
+               crop_y0,
+               crop_x1,
+               crop_y1):
+    nx, ny = arr_zxy.shape[1:]
+    i_slice, j_slice = crop_indices(nx, ny, array_x0, array_y0, array_dx, array_dy, crop_x0, crop_y0, crop_x1, crop_y1)
+    return arr_zxy[:, i_slice, j_slice]
+
+
+def _single_grid(rq: ResQml) -> IjkGridRepresentation:
     z = list(rq.objects(IjkGridRepresentation))
     assert len(z) == 1  # Should be one and only one grid in the object. Multiple grids are not supported (yet)
+    return z[0]
+
+
+def lattice_origin_and_spacing(lattice: Point3dLatticeArray) -> Tuple[float, float, float, float]:
+    """
+    Returns the x and y coordinates of the origin of a two-dimensional, axis-aligned lattice with constant spacing, and
+    the distance between its nodes along the first (I) and second (J) axis, i.e. (x0, y0, dx, dy). Raises ValueError if
+    the lattice is not of this form.
+    """
+    if len(lattice.Offset) != 2 or not all(isinstance(o.Spacing, DoubleConstantArray) for o in lattice.Offset):
+        raise ValueError('Only two-dimensional lattices with constant spacing are supported')
+    (oi, si), (oj, sj) = ((o.Offset, o.Spacing.Value) for o in lattice.Offset)
+    if oi.Coordinate2 != 0.0 or oj.Coordinate1 != 0.0:
+        raise ValueError('Only lattices aligned with the x and y axes are supported')
+    return lattice.Origin.Coordinate1, lattice.Origin.Coordinate2, oi.Coordinate1 * si, oj.Coordinate2 * sj
+
+
+def grid_origin_and_spacing(rq: ResQml, ijk: IjkGridRepresentation) -> Tuple[float, float, float, float]:
+    """
+    Returns the x and y coordinates of the first pillar of the grid, and the pillar spacing along I and J, i.e.
+    (array_x0, array_y0, array_dx, array_dy) as used by crop_array. Only a few control points are read from file.
+    Raises ValueError if the spacing is zero along either axis.
+    """
+    control_points = ijk.Geometry.Points.ParametricLines.ControlPoints
+    if isinstance(control_points, Point3dLatticeArray):
+        x0, y0, dx, dy = lattice_origin_and_spacing(control_points)
+    else:
+        assert isinstance(control_points, Point3dHdf5Array)
+        cps = _open_dataset(rq, control_points.Coordinates)
+        if cps.ndim == 3:
+            # Outdated format with one control point per pillar
+            p00, p10, p01 = cps[0, 0], cps[min(1, cps.shape[0] - 1), 0], cps[0, min(1, cps.shape[1] - 1)]
+        else:
+            # Split pillars of column (0, 0), located at the corners given by SPLIT_PILLAR_CORNERS
+            p00, p10, p01 = (cps[SPLIT_PILLAR_CORNERS.index(c), 0, 0] for c in ((0, 0), (1, 0), (0, 1)))
+        x0, y0, dx, dy = float(p00[0]), float(p00[1]), float(p10[0] - p00[0]), float(p01[1] - p00[1])
+    if dx == 0.0 or dy == 0.0:
+        raise ValueError(f'Degenerate grid geometry: The pillar spacing ({dx}, {dy}) is zero')
+    return x0, y0, dx, dy
+
+
+def _crop_slices(rq: ResQml, ijk: IjkGridRepresentation, nk: int, ni: int, nj: int,
+                 crop_box: Optional[Tuple[float, float, float, float]], k_range: Optional[Tuple[int, int]]
+                 ) -> Tuple[slice, slice, slice]:
+    # Index slices (k, i, j) corresponding to the crop box and K range
+    if k_range is None:
+        k_slice = slice(0, nk)
+    else:
+        assert 0 <= k_range[0] < k_range[1] <= nk  # Verify that the K range is properly specified
+        k_slice = slice(*k_range)
+    if crop_box is None:
+        return k_slice, slice(0, ni), slice(0, nj)
+    i_slice, j_slice = crop_indices(ni, nj, *grid_origin_and_spacing(rq, ijk), *crop_box)
+    return k_slice, i_slice, j_slice
+
+
+def extract_geometry(rq: ResQml, flatten_pillars: bool, indexing: str,
+                     crop_box: Optional[Tuple[float, float, float, float]] = None,
+                     k_range: Optional[Tuple[int, int]] = None,
+                     out: Optional[np.ndarray] = None,
+                     memmap: bool = False,
+                     lazy: bool = False):
+    """
+    Extracts the grid geometry: the grid object, the x and y coordinates of the (split) pillars, and the pillar
+    elevations.
+
+    :param crop_box: If provided, only the pillars within the box (x0, y0, x1, y1) are extracted. Same semantics as
+                     crop_array. Only the selected part of the data sets is read from file
+    :param k_range:  If provided, only the layers k_range[0] <= k < k_range[1] are extracted
+    :param out:      If provided, the pillar elevations are read directly into this buffer, which must have the shape
+                     of the returned pillars. The buffer is returned in place of the pillars
+    :param memmap:   If True, the pillar elevations are returned as a read-only view of a memory map of the HDF5 file,
+                     if the data set is stored contiguously and uncompressed. Otherwise, they are read as usual
+    :param lazy:     If True, the control point coordinates and pillar elevations are returned as Hdf5ArrayViews, and
+                     are only read (in part) when indexed and converted to arrays. Cannot be combined with out or memmap
+    """
+    assert indexing in ('ijk', 'kij')
+    assert not lazy or (out is None and not memmap)
+    # Extract pillars and other grid parameters
+    ijk = _single_grid(rq)
+    pillars_ds = _pillar_dataset(rq, ijk)
+    # The outdated format (see below) has no split pillar axis
+    ni, nj, nk = pillars_ds.shape[-3:]
+    ks, is_, js = _crop_slices(rq, ijk, nk, ni, nj, crop_box, k_range)
+    control_points = ijk.Geometry.Points.ParametricLines.ControlPoints
+    if isinstance(control_points, Point3dLatticeArray):
+        xx, yy = lattice_coordinates(control_points, ni, nj)
+        xx, yy = xx[:, is_, js], yy[:, is_, js]
+    else:
+        assert isinstance(control_points, Point3dHdf5Array)
+        cps_ds = _open_dataset(rq, control_points.Coordinates)
+        cps = Hdf5ArrayView(cps_ds) if lazy else cps_ds
+        xx, yy = _control_point_coordinates(cps[is_, js] if cps_ds.ndim == 3 else cps[:, is_, js])
+        if not lazy:
+            xx, yy = np.array(xx), np.array(yy)
+        if xx.ndim == 2:
+            # Pillars are technically already flattened when this format is used, as the outdated format did not
+            # support a non-flattened format. The primary purpose of the new format was to support this types of
+            # pillars.
+            flatten_pillars = False
+    if flatten_pillars:
+        xx = xx[0, :, :]
+        yy = yy[0, :, :]
+    if lazy:
+        pillars = _pillar_view(pillars_ds, flatten_pillars, (is_, js, ks), indexing)
+    else:
+        pillars = _read_pillars(pillars_ds, flatten_pillars, (is_, js, ks), indexing, out, memmap)
+    return ijk, xx, yy, pillars
+
+
+def _pillar_dataset(rq: ResQml, ijk: IjkGridRepresentation) -> h5py.Dataset:
     # Assert on types to be explicit about the assumed types and to aid code completion
-    ijk = z[0]
     assert isinstance(ijk, IjkGridRepresentation)
     assert isinstance(ijk.Geometry, IjkGridGeometry)
     assert isinstance(ijk.Geometry.Points, Point3dParametricArray)
     assert isinstance(ijk.Geometry.Points.ParametricLines, ParametricLineArray)
     assert isinstance(ijk.Geometry.Points.ParametricLines.ControlPointParameters, DoubleHdf5Array)
-    pillars = _extract_dataset(rq, ijk.Geometry.Points.ParametricLines.ControlPointParameters.Values)
-    assert isinstance(ijk.Geometry.Points.ParametricLines.ControlPoints, Point3dHdf5Array)
-    xxyyzz = _extract_dataset(rq, ijk.Geometry.Points.ParametricLines.ControlPoints.Coordinates)
+    return _open_dataset(rq, ijk.Geometry.Points.ParametricLines.ControlPointParameters.Values)
+
+
+def _read_pillars(pillars_ds: h5py.Dataset, flatten_pillars: bool, selection: Tuple[slice, slice, slice],
+                  indexing: str, out: Optional[np.ndarray], memmap: bool) -> np.ndarray:
+    # Reads the (i, j, k) selection of the pillar elevations. The outdated format has no split pillar axis, and is
+    # therefore never flattened
+    is_, js, ks = selection
+    axes = {'ijk': (0, 1, 2), 'kij': (2, 0, 1)}[indexing]
+    if flatten_pillars and pillars_ds.ndim == 4:
+        if has_shared_split_pillars(pillars_ds):
+            # All split pillars refer the same physical data set. Reading one of them is sufficient
+            pillars = _read_dataset(pillars_ds, (0, is_, js, ks), axes, out, memmap)
+        elif out is not None:
+            pillars = h5streaming.read_transposed(pillars_ds, (slice(None), is_, js, ks), axes, out, mean_first_axis=True)
+        else:
+            source = _memmap_dataset(pillars_ds) if memmap else None
+            pillars = np.mean((pillars_ds if source is None else source)[:, is_, js, ks], axis=0).transpose(axes)
+    else:
+        # Only the last three axes (i, j, k) are reordered. A leading split pillar axis is kept in place
+        split = (slice(None),) * (pillars_ds.ndim - 3)
+        axes = tuple(range(len(split))) + tuple(len(split) + a for a in axes)
+        pillars = _read_dataset(pillars_ds, split + (is_, js, ks), axes, out, memmap)
+    return pillars
+
+
+def _pillar_view(pillars_ds: h5py.Dataset, flatten_pillars: bool, selection: Tuple[slice, slice, slice],
+                 indexing: str) -> Hdf5ArrayView:
+    # Lazy equivalent of _read_pillars
+    is_, js, ks = selection
+    axes = {'ijk': (0, 1, 2), 'kij': (2, 0, 1)}[indexing]
+    if flatten_pillars and pillars_ds.ndim == 4:
+        if has_shared_split_pillars(pillars_ds):
+            # All split pillars refer the same physical data set. Only the first one is read
+            view = Hdf5ArrayView(pillars_ds)[0]
+        else:
+            view = Hdf5ArrayView(pillars_ds, mean_axis=0)
+    else:
+        view = Hdf5ArrayView(pillars_ds)
+    lead = tuple(range(view.ndim - 3))
+    return view[..., is_, js, ks].transpose(lead + tuple(len(lead) + a for a in axes))
+
+
+def _control_point_coordinates(xxyyzz):
     if xxyyzz.ndim == 3:
         # This is technically an outdated format, but is supported nonetheless
-        xx, yy = xxyyzz[:, :, 0], xxyyzz[:, :, 1]
-        # Pillars are technically already flattened when this format is used, as the outdated format did not support
-        # a non-flattened format. The primary purpose of the new format was to support this types of pillars.
-        flatten_pillars = False
+        return xxyyzz[:, :, 0], xxyyzz[:, :, 1]
     else:
         assert xxyyzz.ndim == 4
-        xx, yy = xxyyzz[:, :, :, 0], xxyyzz[:, :, :, 1]
-    if flatten_pillars:
-        xx = xx[0, :, :]
-        yy = yy[0, :, :]
-        pillars = np.mean(pillars, axis=0)
-    pillars = pillars.transpose({'ijk': (0, 1, 2), 'kij': (2, 0, 1)}[indexing])
-    return ijk, xx, yy, pillars
+        return xxyyzz[:, :, :, 0], xxyyzz[:, :, :, 1]
+
+
+def lattice_coordinates(lattice: Point3dLatticeArray, ni: int, nj: int):
+    """
+    Expands the lattice describing the lateral position of the split pillars to x and y coordinates of shape
+    (4, ni, nj). The returned arrays are read-only broadcast views, so the memory usage is proportional to ni + nj
+    rather than ni * nj.
+    """
+    x0, y0, dx, dy = lattice_origin_and_spacing(lattice)
+    di = np.array([c[0] for c in SPLIT_PILLAR_CORNERS])[:, np.newaxis, np.newaxis]
+    dj = np.array([c[1] for c in SPLIT_PILLAR_CORNERS])[:, np.newaxis, np.newaxis]
+    xx = x0 + (np.arange(ni)[np.newaxis, :, np.newaxis] + di) * dx
+    yy = y0 + (np.arange(nj)[np.newaxis, np.newaxis, :] + dj) * dy
+    return np.broadcast_to(xx, (4, ni, nj)), np.broadcast_to(yy, (4, ni, nj))
+
 
+def extract_property(resqml: ResQml, supp_rep: Optional[AbstractRepresentation], h5_path: str, categorical: bool,
+                     crop_box: Optional[Tuple[float, float, float, float]] = None,
+                     k_range: Optional[Tuple[int, int]] = None,
+                     indexing: str = 'kij',
+                     out: Optional[np.ndarray] = None,
+                     memmap: bool = False,
+                     lazy: bool = False):
+    """
+    Extracts the values of a property as a (k, i, j) array, or an (i, j, k) array if indexing is 'ijk'
 
-def extract_property(resqml: ResQml, supp_rep: Optional[AbstractRepresentation], h5_path: str, categorical: bool):
+    :param crop_box: If provided, only the cells within the box (x0, y0, x1, y1) are extracted. Same semantics as
+                     crop_array, relative to the geometry of the supporting representation. Only the selected part of
+                     the data set is read from file
+    :param k_range:  If provided, only the layers k_range[0] <= k < k_range[1] are extracted
+    :param out:      If provided, the values are read directly into this buffer, which must have the shape of the
+                     returned array. The buffer is returned
+    :param memmap:   If True, the values are returned as a read-only view of a memory map of the HDF5 file, if the
+                     data set is stored contiguously and uncompressed. Otherwise, they are read as usual
+    :param lazy:     If True, the values are returned as an Hdf5ArrayView, and are only read (in part) when indexed and
+                     converted to an array. Cannot be combined with out or memmap
+    """
+    assert indexing in ('ijk', 'kij')
+    assert not lazy or (out is None and not memmap)
+    prop = _find_property(resqml, supp_rep, h5_path, categorical)
+    ds = _open_dataset(resqml, prop.PatchOfValues.Values.Values)
+    selection = _crop_slices(resqml, prop.SupportingRepresentation, *ds.shape, crop_box, k_range)
+    axes = {'kij': (0, 1, 2), 'ijk': (1, 2, 0)}[indexing]
+    if lazy:
+        return Hdf5ArrayView(ds)[selection].transpose(axes)
+    return _read_dataset(ds, selection, axes, out, memmap)
+
+
+def _find_property(resqml: ResQml, supp_rep: Optional[AbstractRepresentation], h5_path: str, categorical: bool
+                   ) -> Union[ContinuousProperty, CategoricalProperty]:
     if categorical:
         p_type = CategoricalProperty
         a_type = IntegerHdf5Array
@@ -74,21 +274,125 @@ def extract_property(resqml: ResQml, supp_rep: Optional[AbstractRepresentation],
         p_type = ContinuousProperty
         a_type = DoubleHdf5Array
     props = [
-        a for a in resqml.objects(p_type)
-        if isinstance(a, p_type)
-        and isinstance(a.PatchOfValues.Values, a_type)
+        a for a in resqml.find_by_hdf5_path(h5_path, p_type)
+        if isinstance(a.PatchOfValues.Values, a_type)
         and a.PatchOfValues.Values.Values.PathInHdfFile == h5_path
         and (supp_rep is None or a.SupportingRepresentation.uuid == supp_rep.uuid)
     ]
     assert len(props) == 1
-    prop = props[0].PatchOfValues.Values
-    assert isinstance(prop, a_type)
-    return _extract_dataset(resqml, prop.Values)
+    return props[0]
+
+
+@dataclass
+class LayerBlock:
+    """
+    Pillar elevations and property values of the layers k0 <= k < k1 of a grid, as yielded by iterate_k_blocks
+
+    :param k0:          First layer of the block
+    :param k1:          End (exclusive) of the layers of the block
+    :param pillars:     Pillar elevations of the layers, of shape (k1 - k0, ni, nj). If the pillars are not flattened,
+                        the split pillar axis is kept first, i.e. (4, k1 - k0, ni, nj)
+    :param properties:  Property values of the layers by HDF5 path, of shape (k1 - k0, ni, nj)
+    """
+    k0: int
+    k1: int
+    pillars: np.ndarray
+    properties: Dict[str, np.ndarray]
+
+
+def iterate_k_blocks(rq: ResQml,
+                     continuous: Sequence[str] = (),
+                     categorical: Sequence[str] = (),
+                     block_size: int = 1,
+                     flatten_pillars: bool = True,
+                     crop_box: Optional[Tuple[float, float, float, float]] = None,
+                     k_range: Optional[Tuple[int, int]] = None,
+                     read_ahead: int = 1) -> Iterator[LayerBlock]:
+    """
+    Iterates the grid in blocks of block_size layers, yielding the pillar elevations and property values of each block.
+    Only the layers of a block are read from file, so memory usage is proportional to the block size rather than the
+    size of the grid. Blocks are read ahead in a background thread while the caller processes the current block.
+
+    :param continuous:  HDF5 paths of the continuous properties to extract
+    :param categorical: HDF5 paths of the categorical properties to extract
+    :param block_size:  Number of layers per block. The last block may be smaller
+    :param crop_box:    If provided, only the cells within the box (x0, y0, x1, y1) are extracted. See extract_geometry
+    :param k_range:     If provided, only the layers k_range[0] <= k < k_range[1] are iterated
+    :param read_ahead:  Number of blocks read ahead of the block being processed. 0 disables the background thread
+    """
+    assert block_size > 0 and read_ahead >= 0
+    ijk = _single_grid(rq)
+    pillars_ds = _pillar_dataset(rq, ijk)
+    ni, nj, nk = pillars_ds.shape[-3:]
+    ks, is_, js = _crop_slices(rq, ijk, nk, ni, nj, crop_box, k_range)
+    datasets = {
+        h5_path: _open_dataset(rq, _find_property(rq, ijk, h5_path, is_categorical).PatchOfValues.Values.Values)
+        for paths, is_categorical in ((continuous, False), (categorical, True))
+        for h5_path in paths
+    }
+
+    def _read_block(k0: int, k1: int) -> LayerBlock:
+        pillars = _read_pillars(pillars_ds, flatten_pillars, (is_, js, slice(k0, k1)), 'kij', None, False)
+        properties = {h5_path: np.array(ds[k0:k1, is_, js]) for h5_path, ds in datasets.items()}
+        return LayerBlock(k0, k1, pillars, properties)
 
+    blocks = [(k0, min(k0 + block_size, ks.stop)) for k0 in range(ks.start, ks.stop, block_size)]
+    yield from h5streaming.prefetch(blocks, lambda b: _read_block(*b), read_ahead)
 
-def _extract_dataset(resqml: ResQml, hdf5_dataset: Hdf5Dataset):
+
+def iterate_layers(rq: ResQml,
+                   continuous: Sequence[str] = (),
+                   categorical: Sequence[str] = (),
+                   flatten_pillars: bool = True,
+                   crop_box: Optional[Tuple[float, float, float, float]] = None,
+                   k_range: Optional[Tuple[int, int]] = None,
+                   read_ahead: int = 1) -> Iterator[Tuple[int, np.ndarray, Dict[str, np.ndarray]]]:
+    """
+    Iterates the grid layer by layer, yielding (k, pillar elevations, property values by HDF5 path) for each layer. The
+    pillar elevations and property values have shape (ni, nj), or (4, ni, nj) for pillars that are not flattened. See
+    iterate_k_blocks for the parameters
+    """
+    for b in iterate_k_blocks(rq, continuous, categorical, 1, flatten_pillars, crop_box, k_range, read_ahead):
+        pillars = b.pillars[:, 0] if b.pillars.ndim == 4 else b.pillars[0]
+        yield b.k0, pillars, {h5_path: values[0] for h5_path, values in b.properties.items()}
+
+
+def has_shared_split_pillars(h5ds: h5py.Dataset) -> bool:
+    """
+    Checks if the split pillar data set is a virtual data set where each of the four split pillars maps to the same
+    source data set
+    """
+    if not h5ds.is_virtual:
+        return False
+    sources = h5ds.virtual_sources()
+    return len(sources) == h5ds.shape[0] and len({(s.file_name, s.dset_name) for s in sources}) == 1
+
+
+def _open_dataset(resqml: ResQml, hdf5_dataset: Hdf5Dataset) -> h5py.Dataset:
+    # The file is kept open by the pool of the ResQml instance, and is closed with it
     hdf5_path = resqml.get_full_hdf5_reference(hdf5_dataset.HdfProxy)
-    h5ds = h5py.File(hdf5_path, mode='r')
-    hdf5_path = hdf5_dataset.PathInHdfFile
-    # Convert to ndarray. This yields easier-to-read error message if something goes wrong with indexing (or similar)
-    return np.array(h5ds[hdf5_path])
+    return resqml.hdf5_pool.get(hdf5_path)[hdf5_dataset.PathInHdfFile]
+
+
+def _memmap_dataset(ds: h5py.Dataset) -> Optional[np.memmap]:
+    """
+    Read-only memory map of the values of ds, or None if ds is not stored contiguously and uncompressed in its file
+    """
+    if ds.is_virtual or ds.chunks is not None or ds.external is not None or ds.size == 0:
+        return None
+    offset = ds.id.get_offset()
+    # Offsets are relative to the end of the user block, if any
+    if offset is None or ds.file.userblock_size != 0:
+        return None
+    return np.memmap(ds.file.filename, dtype=ds.dtype, mode='r', offset=offset, shape=ds.shape)
+
+
+def _read_dataset(ds: h5py.Dataset, selection: Tuple, axes: Tuple[int, ...], out: Optional[np.ndarray],
+                  memmap: bool) -> np.ndarray:
+    # Reads the selection of ds, transposed by axes, into out, as a memory map view or as a new array
+    if out is not None:
+        return h5streaming.read_transposed(ds, selection, axes, out)
+    source = _memmap_dataset(ds) if memmap else None
+    if source is not None:
+        return source[selection].transpose(axes)
+    return np.array(ds[selection]).transpose(axes)
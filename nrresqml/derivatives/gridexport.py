@@ -0,0 +1,387 @@
+import datetime
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple, IO
+
+import numpy as np
+
+from nrresqml.derivatives import h5streaming
+from nrresqml.derivatives.dataextraction import extract_geometry, extract_property, grid_origin_and_spacing
+from nrresqml.derivatives.h5arrayview import Hdf5ArrayView
+from nrresqml.resqml import ResQml
+from nrresqml.structures.resqml.properties import CategoricalProperty, ContinuousProperty
+from nrresqml.structures.resqml.representations import IjkGridRepresentation
+
+
+# Number of values per line in GRDECL files
+_GRDECL_VALUES_PER_LINE = 6
+# Maximum length of GRDECL keywords, and the keywords of the grid that properties must not use
+_GRDECL_KEYWORD_LENGTH = 8
+_GRDECL_GRID_KEYWORDS = ('SPECGRID', 'COORD', 'ZCORN', 'ACTNUM')
+# Value of undefined float parameters in ROFF files
+_ROFF_UNDEFINED_FLOAT = -999.0
+
+
+@dataclass
+class _GridProperty:
+    name: str
+    discrete: bool
+    values: Hdf5ArrayView
+
+
+@dataclass
+class _ExportGrid:
+    """
+    The parts of a grid that are exported, read lazily. Each column (i, j) of cells has flat tops, i.e. the four corners
+    of a cell have the same elevation. Layer k of the exported grid lies between the pillar nodes k (bottom) and k + 1
+    (top), so the grid has one layer less than the number of pillar nodes.
+    """
+    # Lateral position of the corners of the columns, of shape (ni + 1, nj + 1)
+    node_x: np.ndarray
+    node_y: np.ndarray
+    # Elevation of the pillar nodes of each column, of shape (nk, ni, nj). Increases with k
+    elevation: Hdf5ArrayView
+    properties: List[_GridProperty]
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """ Number of cells (ni, nj, nl) """
+        nk, ni, nj = self.elevation.shape
+        return ni, nj, nk - 1
+
+    def elevation_range(self) -> Tuple[float, float]:
+        # Elevations are monotonic along the pillars, so the extremes are found in the first and last node layers
+        ends = np.stack([np.asarray(self.elevation[0]), np.asarray(self.elevation[-1])])
+        return float(np.fmin.reduce(ends, axis=None)), float(np.fmax.reduce(ends, axis=None))
+
+
+def _node_coordinates(rq: ResQml, ijk: IjkGridRepresentation, ni: int, nj: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Lateral position of the lattice nodes at the corners of the columns, each of shape (ni + 1, nj + 1). Only corner 0
+    # of the split pillars is used, since corner 3 of dense control points written by earlier versions repeats the last
+    # row of the grid
+    x0, y0, dx, dy = grid_origin_and_spacing(rq, ijk)
+    return np.meshgrid(x0 + np.arange(ni + 1) * dx, y0 + np.arange(nj + 1) * dy, indexing='ij')
+
+
+def _export_grid(rq: ResQml, properties: Optional[Sequence[str]]) -> _ExportGrid:
+    ijk, xx, yy, _ = extract_geometry(rq, False, 'kij', lazy=True)
+    if xx.ndim != 3:
+        raise ValueError('Grids with control points on the outdated (shared pillar) format cannot be exported')
+    _, _, _, elevation = extract_geometry(rq, True, 'kij', lazy=True)
+    _, ni, nj = elevation.shape
+    props = []
+    for p_type, discrete in ((ContinuousProperty, False), (CategoricalProperty, True)):
+        for p in rq.objects(p_type):
+            name = str(p.PatchOfValues.Values.Values.PathInHdfFile)
+            if p.SupportingRepresentation.uuid != ijk.uuid or (properties is not None and name not in properties):
+                continue
+            values = extract_property(rq, ijk, name, discrete, lazy=True)
+            if values.shape != elevation.shape:
+                print(f'{name}: Shape {values.shape} does not match the grid, the property is not exported')
+                continue
+            props.append(_GridProperty(name, discrete, values))
+    if properties is not None:
+        missing = set(properties) - {p.name for p in props}
+        if len(missing) > 0:
+            raise ValueError(f'Properties not found on the grid: {", ".join(sorted(missing))}')
+    return _ExportGrid(*_node_coordinates(rq, ijk, ni, nj), elevation, props)
+
+
+def _k_blocks(n: int, block_size: int) -> List[Tuple[int, int]]:
+    return [(k0, min(n, k0 + block_size)) for k0 in range(0, n, block_size)]
+
+
+def _write_grdecl_values(fh: IO[str], values: np.ndarray, fmt: str):
+    # GRDECL has no representation of undefined values, they are written as 0
+    values = np.nan_to_num(values.ravel(), nan=0.0)
+    n_full = len(values) // _GRDECL_VALUES_PER_LINE * _GRDECL_VALUES_PER_LINE
+    if n_full > 0:
+        np.savetxt(fh, values[:n_full].reshape(-1, _GRDECL_VALUES_PER_LINE), fmt=fmt)
+    if n_full < len(values):
+        np.savetxt(fh, values[n_full:].reshape(1, -1), fmt=fmt)
+
+
+def _grdecl_keyword(name: str) -> str:
+    # Upper case letters, digits and underscores, starting with a letter, truncated to the maximum keyword length
+    keyword = re.sub(r'[^A-Z0-9_]', '', name.upper())
+    if not keyword[:1].isalpha():
+        keyword = 'P' + keyword
+    return keyword[:_GRDECL_KEYWORD_LENGTH]
+
+
+def _grdecl_keywords(names: Sequence[str], keywords: Optional[Mapping[str, str]]) -> Dict[str, str]:
+    """
+    GRDECL keywords of the properties with the given names. Keywords given by the caller are used as-is, other names
+    are sanitized and truncated. Duplicates are resolved by replacing the end of the keyword with a number.
+    """
+    keywords = keywords or {}
+    used = set(_GRDECL_GRID_KEYWORDS)
+    for name in names:
+        if name not in keywords:
+            continue
+        keyword = keywords[name]
+        if re.fullmatch(r'[A-Z][A-Z0-9_]{0,%d}' % (_GRDECL_KEYWORD_LENGTH - 1), keyword) is None:
+            raise ValueError(f'Invalid GRDECL keyword "{keyword}" for property {name}')
+        if keyword in used:
+            raise ValueError(f'GRDECL keyword "{keyword}" of property {name} is already in use')
+        used.add(keyword)
+    result = {}
+    for name in names:
+        if name in keywords:
+            result[name] = keywords[name]
+            continue
+        base = _grdecl_keyword(name)
+        keyword, n = base, 1
+        while keyword in used:
+            suffix = str(n)
+            keyword, n = base[:_GRDECL_KEYWORD_LENGTH - len(suffix)] + suffix, n + 1
+        used.add(keyword)
+        result[name] = keyword
+    return result
+
+
+def export_grdecl(rq: ResQml, path: str, properties: Optional[Sequence[str]] = None, block_size: int = 16,
+                  read_ahead: int = 1, keywords: Optional[Mapping[str, str]] = None):
+    """
+    Exports the (single) grid of a ResQml database and its properties to an Eclipse GRDECL (ASCII) file. The grid is
+    read and written in blocks of K layers, so that memory usage is independent of the number of layers.
+
+    The GRDECL grid has the same I and J axes as the ResQml grid, while K is flipped so that the first layer is the top
+    (youngest) layer. Pillars are vertical, and z values are depths. Cells with undefined elevations are inactive.
+
+    :param rq:          ResQml database. Must contain a single IjkGridRepresentation
+    :param path:        Path of the GRDECL file
+    :param properties:  HDF5 paths of the properties to export. All properties of the grid if None
+    :param block_size:  Number of layers read and written at a time
+    :param read_ahead:  Number of blocks read ahead of the block being written. 0 disables the background thread
+    :param keywords:    GRDECL keywords of the properties, by HDF5 path. Keywords must be upper case with at most eight
+                        characters. Properties without a keyword are named by their sanitized and truncated HDF5 path.
+                        The mapping is written as a comment at the start of the file
+    """
+    grid = _export_grid(rq, properties)
+    ni, nj, nl = grid.shape
+    e_min, e_max = grid.elevation_range()
+    property_keywords = _grdecl_keywords([p.name for p in grid.properties], keywords)
+    with open(path, 'w') as fh:
+        if len(grid.properties) > 0:
+            fh.write('-- Property keywords and the HDF5 data sets they are exported from\n')
+            for p in grid.properties:
+                fh.write(f'-- {property_keywords[p.name]:<{_GRDECL_KEYWORD_LENGTH}} {p.name}\n')
+            fh.write('\n')
+        fh.write('SPECGRID\n')
+        fh.write(f'{ni} {nj} {nl} 1 F /\n\n')
+        # Vertical pillars at the corners of the columns, given by their top and bottom points. I varies fastest
+        coord = np.empty((nj + 1, ni + 1, 6), dtype=np.float64)
+        coord[:, :, 0] = coord[:, :, 3] = grid.node_x.T
+        coord[:, :, 1] = coord[:, :, 4] = grid.node_y.T
+        coord[:, :, 2] = -e_max
+        coord[:, :, 5] = -e_min
+        fh.write('COORD\n')
+        _write_grdecl_values(fh, coord, '%.9g')
+        fh.write('/\n\n')
+
+        # Depth of the top and bottom corners of each layer, starting with the top layer. Flipped layer kk is ResQml
+        # layer nl - 1 - kk, with its top at node nl - kk and its bottom at node nl - 1 - kk
+        def _read_depth(block: Tuple[int, int]) -> np.ndarray:
+            kk0, kk1 = block
+            return -np.asarray(grid.elevation[nl - kk1:nl - kk0 + 1])[::-1]
+
+        fh.write('ZCORN\n')
+        for d in h5streaming.prefetch(_k_blocks(nl, block_size), _read_depth, read_ahead):
+            # Sheets of shape (layers, top/bottom, 2 * nj, 2 * ni), where all four corners of a column are equal
+            sheets = np.stack([d[:-1], d[1:]], axis=1).transpose((0, 1, 3, 2))
+            sheets = np.repeat(np.repeat(sheets, 2, axis=2), 2, axis=3)
+            _write_grdecl_values(fh, sheets, '%.7g')
+        fh.write('/\n\n')
+
+        # Cells are active if the elevations of their top and bottom nodes are defined
+        fh.write('ACTNUM\n')
+        for d in h5streaming.prefetch(_k_blocks(nl, block_size), _read_depth, read_ahead):
+            defined = np.isfinite(d)
+            _write_grdecl_values(fh, (defined[:-1] & defined[1:]).transpose((0, 2, 1)), '%d')
+        fh.write('/\n\n')
+
+        for p in grid.properties:
+            def _read_values(block: Tuple[int, int], values=p.values) -> np.ndarray:
+                kk0, kk1 = block
+                return np.asarray(values[nl - kk1:nl - kk0])[::-1].transpose((0, 2, 1))
+
+            fh.write(f'{property_keywords[p.name]}\n')
+            for v in h5streaming.prefetch(_k_blocks(nl, block_size), _read_values, read_ahead):
+                _write_grdecl_values(fh, v, '%d' if p.discrete else '%.7g')
+            fh.write('/\n\n')
+
+
+class _RoffWriter:
+    """
+    Writer of binary ROFF files. Arrays are not written immediately. Instead, space is reserved for them in the file,
+    and they are filled through memory maps once all tags have been written.
+    """
+
+    def __init__(self, fh: IO[bytes]) -> None:
+        self._fh = fh
+        self._fh.write(b'roff-bin\0#ROFF file#\0#Creator: nrresqml#\0')
+
+    def _string(self, value: str):
+        self._fh.write(value.encode('ascii') + b'\0')
+
+    def tag(self, name: str):
+        self._string('tag')
+        self._string(name)
+
+    def end_tag(self):
+        self._string('endtag')
+
+    def write_int(self, name: str, value: int):
+        self._string('int')
+        self._string(name)
+        self._fh.write(np.array(value, dtype='<i4').tobytes())
+
+    def write_float(self, name: str, value: float):
+        self._string('float')
+        self._string(name)
+        self._fh.write(np.array(value, dtype='<f4').tobytes())
+
+    def write_char(self, name: str, value: str):
+        self._string('char')
+        self._string(name)
+        self._string(value)
+
+    def write_array(self, type_name: str, name: str, values: np.ndarray):
+        self._string('array')
+        self._string(type_name)
+        self._string(name)
+        self._fh.write(np.array(values.size, dtype='<i4').tobytes())
+        self._fh.write(values.tobytes())
+
+    def reserve_array(self, type_name: str, name: str, dtype, size: int) -> int:
+        """ Reserves space for an array of the given size, and returns the offset of its values in the file """
+        self._string('array')
+        self._string(type_name)
+        self._string(name)
+        self._fh.write(np.array(size, dtype='<i4').tobytes())
+        offset = self._fh.tell()
+        # The skipped region is filled with zeros when the file is extended, without writing them
+        self._fh.seek(offset + size * np.dtype(dtype).itemsize)
+        return offset
+
+
+# ROFF types of the exported values
+_ROFF_FLOAT = np.dtype('<f4')
+_ROFF_INT = np.dtype('<i4')
+_ROFF_BYTE = np.dtype('u1')
+
+
+def export_roff(rq: ResQml, path: str, properties: Optional[Sequence[str]] = None, block_size: int = 16,
+                read_ahead: int = 1):
+    """
+    Exports the (single) grid of a ResQml database and its properties to a binary ROFF file, with the properties as
+    parameters in the same file. The grid is read in blocks of K layers, which are written into the file through memory
+    maps, so that memory usage is independent of the size of the grid.
+
+    The ROFF grid has the same I, J and K axes as the ResQml grid. The layers of ROFF grids are counted from the bottom,
+    like the (depositional) layers of the ResQml grid. Each pillar node is split into four z values, one per adjacent
+    column (splitEnz = 4). The z values are stored as elevations with zscale = -1, i.e. the z values of the grid are
+    depths. Cells with undefined elevations are inactive.
+
+    :param rq:          ResQml database. Must contain a single IjkGridRepresentation
+    :param path:        Path of the ROFF file
+    :param properties:  HDF5 paths of the properties to export. All properties of the grid if None
+    :param block_size:  Number of layers read and written at a time
+    :param read_ahead:  Number of blocks read ahead of the block being written. 0 disables the background thread
+    """
+    grid = _export_grid(rq, properties)
+    ni, nj, nl = grid.shape
+    nk = nl + 1
+    e_min, e_max = grid.elevation_range()
+    x_offset, y_offset = float(grid.node_x[0, 0]), float(grid.node_y[0, 0])
+    with open(path, 'wb') as fh:
+        w = _RoffWriter(fh)
+        w.tag('filedata')
+        w.write_int('byteswaptest', 1)
+        w.write_char('filetype', 'grid')
+        w.write_char('creationDate', datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S'))
+        w.end_tag()
+        w.tag('version')
+        w.write_int('major', 2)
+        w.write_int('minor', 0)
+        w.end_tag()
+        w.tag('dimensions')
+        w.write_int('nX', ni)
+        w.write_int('nY', nj)
+        w.write_int('nZ', nl)
+        w.end_tag()
+        w.tag('translate')
+        w.write_float('xoffset', x_offset)
+        w.write_float('yoffset', y_offset)
+        w.write_float('zoffset', 0.0)
+        w.end_tag()
+        w.tag('scale')
+        w.write_float('xscale', 1.0)
+        w.write_float('yscale', 1.0)
+        w.write_float('zscale', -1.0)
+        w.end_tag()
+        # Vertical pillars given by their bottom and top points, relative to the offset. J varies fastest
+        corner_lines = np.empty((ni + 1, nj + 1, 2, 3), dtype=_ROFF_FLOAT)
+        corner_lines[:, :, :, 0] = (grid.node_x - x_offset)[:, :, np.newaxis]
+        corner_lines[:, :, :, 1] = (grid.node_y - y_offset)[:, :, np.newaxis]
+        corner_lines[:, :, 0, 2] = e_min
+        corner_lines[:, :, 1, 2] = e_max
+        w.tag('cornerLines')
+        w.write_array('float', 'data', corner_lines)
+        w.end_tag()
+        w.tag('zvalues')
+        split_offset = w.reserve_array('byte', 'splitEnz', _ROFF_BYTE, (ni + 1) * (nj + 1) * nk)
+        z_offset = w.reserve_array('float', 'data', _ROFF_FLOAT, (ni + 1) * (nj + 1) * nk * 4)
+        w.end_tag()
+        w.tag('active')
+        active_offset = w.reserve_array('bool', 'data', _ROFF_BYTE, ni * nj * nl)
+        w.end_tag()
+        parameter_offsets = []
+        for p in grid.properties:
+            w.tag('parameter')
+            w.write_char('name', p.name)
+            if p.discrete:
+                parameter_offsets.append((w.reserve_array('int', 'data', _ROFF_INT, ni * nj * nl), _ROFF_INT))
+            else:
+                parameter_offsets.append((w.reserve_array('float', 'data', _ROFF_FLOAT, ni * nj * nl), _ROFF_FLOAT))
+            w.end_tag()
+        w.tag('eof')
+        w.end_tag()
+
+    # Fill the arrays. All arrays are ordered with I varying slowest and K fastest
+    split = np.memmap(path, dtype=_ROFF_BYTE, mode='r+', offset=split_offset, shape=((ni + 1) * (nj + 1) * nk,))
+    split[:] = 4
+    split.flush()
+    del split
+    z_values = np.memmap(path, dtype=_ROFF_FLOAT, mode='r+', offset=z_offset, shape=(ni + 1, nj + 1, nk, 4))
+    active = np.memmap(path, dtype=_ROFF_BYTE, mode='r+', offset=active_offset, shape=(ni, nj, nl))
+    # Whether the elevations of the last node layer of the previous block are defined
+    previous = None
+    for (k0, k1), e in h5streaming.prefetch(
+            _k_blocks(nk, block_size), lambda b: (b, np.asarray(grid.elevation[b[0]:b[1]])), read_ahead):
+        # The four z values of node (i, j) belong to the columns (i - 1, j - 1), (i, j - 1), (i - 1, j) and (i, j).
+        # Missing columns on the boundary repeat their neighbour
+        padded = np.pad(e, ((0, 0), (1, 1), (1, 1)), mode='edge').transpose((1, 2, 0))
+        z_values[:, :, k0:k1, 0] = padded[:-1, :-1]
+        z_values[:, :, k0:k1, 1] = padded[1:, :-1]
+        z_values[:, :, k0:k1, 2] = padded[:-1, 1:]
+        z_values[:, :, k0:k1, 3] = padded[1:, 1:]
+        defined = np.isfinite(e)
+        if previous is not None:
+            defined = np.concatenate([previous[np.newaxis], defined])
+        # Layer k lies between the nodes k and k + 1
+        active[:, :, k1 - len(defined):k1 - 1] = (defined[:-1] & defined[1:]).transpose((1, 2, 0))
+        previous = defined[-1]
+    z_values.flush()
+    active.flush()
+    del z_values, active
+    for p, (offset, dtype) in zip(grid.properties, parameter_offsets):
+        values = np.memmap(path, dtype=dtype, mode='r+', offset=offset, shape=(ni, nj, nl))
+        for (k0, k1), v in h5streaming.prefetch(
+                _k_blocks(nl, block_size), lambda b, pv=p.values: (b, np.asarray(pv[b[0]:b[1]])), read_ahead):
+            if not p.discrete:
+                v = np.where(np.isnan(v), _ROFF_UNDEFINED_FLOAT, v)
+            values[:, :, k0:k1] = v.transpose((1, 2, 0))
+        values.flush()
+        del values
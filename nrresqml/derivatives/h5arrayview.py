@@ -0,0 +1,196 @@
+from typing import Optional, Tuple, Union, List, Iterator
+
+import numpy as np
+
+from nrresqml.derivatives.h5streaming import DEFAULT_BUFFER_BYTES
+
+
+# Selection of a single axis of the source array. Either an index, which removes the axis, or a (start, stop, step)
+# range with a positive step
+_AxisSelection = Union[int, Tuple[int, int, int]]
+
+
+def _range_length(r: Tuple[int, int, int]) -> int:
+    return len(range(*r))
+
+
+class Hdf5ArrayView:
+    """
+    Lazy, read-only view of a (part of a) HDF5 data set, or any other array-like object that supports numpy-style
+    basic indexing. Indexing and transposing the view creates a new view without reading any data. The values are read
+    when the view is converted to an array, e.g. by np.asarray, and only the selected part of the data set is read.
+
+    Optionally, the view averages the source along one of its axes, which is then not an axis of the view. This is how
+    the four split pillars of a grid are flattened.
+
+    :param source:      h5py.Dataset or other array-like object to view
+    :param mean_axis:   If provided, the view is the mean of the source along this axis
+    """
+
+    def __init__(self, source, mean_axis: Optional[int] = None) -> None:
+        self._source = source
+        self._selection = [(0, n, 1) for n in source.shape]  # type: List[_AxisSelection]
+        self._mean_dim = mean_axis
+        self._axes = tuple(d for d in range(len(source.shape)) if d != mean_axis)
+
+    @classmethod
+    def _derive(cls, view: 'Hdf5ArrayView', selection: List[_AxisSelection], axes: Tuple[int, ...]
+                ) -> 'Hdf5ArrayView':
+        derived = cls.__new__(cls)
+        derived._source = view._source
+        derived._selection = selection
+        derived._mean_dim = view._mean_dim
+        derived._axes = axes
+        return derived
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return tuple(_range_length(self._selection[d]) for d in self._axes)
+
+    @property
+    def ndim(self) -> int:
+        return len(self._axes)
+
+    @property
+    def size(self) -> int:
+        return int(np.prod(self.shape))
+
+    @property
+    def dtype(self) -> np.dtype:
+        dtype = np.dtype(self._source.dtype)
+        if self._mean_dim is not None and not np.issubdtype(dtype, np.inexact):
+            return np.dtype(np.float64)
+        return dtype
+
+    @property
+    def T(self) -> 'Hdf5ArrayView':
+        return self.transpose()
+
+    def __len__(self) -> int:
+        if self.ndim == 0:
+            raise TypeError('len() of unsized object')
+        return self.shape[0]
+
+    def __repr__(self) -> str:
+        return f'Hdf5ArrayView(shape={self.shape}, dtype={self.dtype})'
+
+    def transpose(self, *axes) -> 'Hdf5ArrayView':
+        if len(axes) == 1 and isinstance(axes[0], (tuple, list)):
+            axes = tuple(axes[0])
+        if len(axes) == 0:
+            axes = tuple(reversed(range(self.ndim)))
+        if sorted(axes) != list(range(self.ndim)):
+            raise ValueError(f'Invalid axes {axes} for a view with {self.ndim} dimensions')
+        return Hdf5ArrayView._derive(self, list(self._selection), tuple(self._axes[a] for a in axes))
+
+    def __getitem__(self, key) -> Union['Hdf5ArrayView', np.generic]:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if sum(k is Ellipsis for k in key) > 1:
+            raise IndexError('An index can only have a single ellipsis')
+        if Ellipsis in key:
+            e = key.index(Ellipsis)
+            key = key[:e] + (slice(None),) * (self.ndim - len(key) + 1) + key[e + 1:]
+        if len(key) > self.ndim:
+            raise IndexError(f'Too many indices for a view with {self.ndim} dimensions')
+        selection = list(self._selection)
+        axes = []
+        for a, dim in enumerate(self._axes):
+            start, stop, step = selection[dim]
+            n = _range_length(selection[dim])
+            k = key[a] if a < len(key) else slice(None)
+            if isinstance(k, slice):
+                k_start, k_stop, k_step = k.indices(n)
+                if k_step < 0:
+                    raise IndexError('Negative steps are not supported by HDF5 views')
+                selection[dim] = (start + k_start * step, start + max(k_start, k_stop) * step, step * k_step)
+                axes.append(dim)
+            elif isinstance(k, (int, np.integer)):
+                if not -n <= k < n:
+                    raise IndexError(f'Index {k} is out of bounds for axis {a} with size {n}')
+                selection[dim] = start + (int(k) % n) * step
+            else:
+                raise IndexError(f'Unsupported index {k!r}. Only integers, slices and ellipsis are supported')
+        view = Hdf5ArrayView._derive(self, selection, tuple(axes))
+        if view.ndim == 0:
+            return view.read()[()]
+        return view
+
+    def _source_key(self, selection: List[_AxisSelection]) -> tuple:
+        return tuple(s if isinstance(s, int) else slice(*s) for s in selection)
+
+    def _read_selection(self, selection: List[_AxisSelection]) -> np.ndarray:
+        values = np.asarray(self._source[self._source_key(selection)])
+        # Axes of the values, in the order of the source dimensions that are kept
+        dims = [d for d, s in enumerate(selection) if not isinstance(s, int)]
+        if self._mean_dim is not None:
+            values = np.mean(values, axis=dims.index(self._mean_dim))
+            dims.remove(self._mean_dim)
+        return values.transpose(tuple(dims.index(d) for d in self._axes))
+
+    def read(self) -> np.ndarray:
+        """ Reads the values of the view into a new array """
+        return self._read_selection(self._selection)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        values = self.read()
+        return values if dtype is None else values.astype(dtype, copy=False)
+
+    def iter_blocks(self, buffer_bytes: int = DEFAULT_BUFFER_BYTES) -> Iterator[np.ndarray]:
+        """
+        Reads the view in blocks along the slowest varying source axis of the view, such that each block requires at
+        most approximately buffer_bytes bytes. The blocks are in the axis order of the view, and split the view along
+        the view axis that corresponds to the slowest varying source axis.
+        """
+        if self.ndim == 0:
+            yield self.read()
+            return
+        block_dim = min(self._axes)
+        start, _, step = self._selection[block_dim]
+        n = _range_length(self._selection[block_dim])
+        source_bytes = np.dtype(self._source.dtype).itemsize * int(np.prod([
+            _range_length(s) for s in self._selection if not isinstance(s, int)
+        ]))
+        per_item = source_bytes // max(n, 1)
+        block = max(1, buffer_bytes // max(per_item, 1))
+        for b0 in range(0, n, block):
+            b1 = min(n, b0 + block)
+            selection = list(self._selection)
+            selection[block_dim] = (start + b0 * step, start + b1 * step, step)
+            yield self._read_selection(selection)
+
+    def _reduce(self, reduction, empty):
+        partial = [reduction(b) for b in self.iter_blocks() if b.size > 0]
+        if len(partial) == 0:
+            return empty()
+        return reduction(np.array(partial))
+
+    def min(self):
+        """ Minimum of all values. Reads the view in blocks """
+        def _empty():
+            raise ValueError('Zero-size view has no minimum')
+        return self._reduce(np.min, _empty)
+
+    def max(self):
+        """ Maximum of all values. Reads the view in blocks """
+        def _empty():
+            raise ValueError('Zero-size view has no maximum')
+        return self._reduce(np.max, _empty)
+
+    def nanmin(self):
+        """ Minimum of all values, ignoring NaN. Reads the view in blocks """
+        return self._reduce(np.nanmin, lambda: np.nan)
+
+    def nanmax(self):
+        """ Maximum of all values, ignoring NaN. Reads the view in blocks """
+        return self._reduce(np.nanmax, lambda: np.nan)
+
+    def sum(self):
+        """ Sum of all values. Reads the view in blocks """
+        return self._reduce(np.sum, lambda: self.dtype.type(0))
+
+    def mean(self):
+        """ Mean of all values. Reads the view in blocks """
+        if self.size == 0:
+            return np.nan
+        return sum(np.sum(b, dtype=np.float64) for b in self.iter_blocks()) / self.size
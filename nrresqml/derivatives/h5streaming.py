@@ -0,0 +1,247 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, Optional, Tuple, Iterable, Callable, TypeVar
+
+import h5py
+import numpy as np
+
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+# Default memory budget used when streaming data sets
+DEFAULT_BUFFER_BYTES = 64 * 2 ** 20
+# Approximate size of each chunk in the output data sets
+_CHUNK_BYTES = 2 ** 20
+# Attributes that refer to other objects of the source file (NetCDF4 dimension scales). These cannot be carried over to
+# a different file.
+_SKIPPED_ATTRIBUTES = {'DIMENSION_LIST', 'REFERENCE_LIST', 'CLASS', 'NAME', '_Netcdf4Dimid', '_Netcdf4Coordinates'}
+
+
+def slab_ranges(shape: Tuple[int, ...], itemsize: int, buffer_bytes: int) -> Iterator[slice]:
+    """
+    Splits the first axis of an array with the given shape into slabs such that each slab requires at most buffer_bytes
+    bytes. A slab will always contain at least one element along the first axis, even if that exceeds the budget.
+    """
+    layer_bytes = itemsize * int(np.prod(shape[1:]))
+    n = max(1, buffer_bytes // max(layer_bytes, 1))
+    for k0 in range(0, shape[0], n):
+        yield slice(k0, min(k0 + n, shape[0]))
+
+
+def layer_chunks(shape: Tuple[int, ...], itemsize: int) -> Optional[Tuple[int, ...]]:
+    """
+    Chunk shape for a data set that is read and written layer by layer along the first axis. Each chunk spans complete
+    layers and is approximately _CHUNK_BYTES large.
+    """
+    if len(shape) == 0 or 0 in shape:
+        return None
+    layer_bytes = itemsize * int(np.prod(shape[1:]))
+    n = max(1, min(shape[0], _CHUNK_BYTES // max(layer_bytes, 1)))
+    return (n,) + tuple(shape[1:])
+
+
+def block_chunks(shape: Tuple[int, ...], itemsize: int) -> Tuple[int, ...]:
+    """
+    Chunk shape for a data set that is read and written in blocks of arbitrary shape. The largest chunk dimension is
+    halved until the chunk is approximately _CHUNK_BYTES large.
+    """
+    chunks = [max(1, n) for n in shape]
+    while itemsize * int(np.prod(chunks)) > _CHUNK_BYTES and max(chunks) > 1:
+        i = int(np.argmax(chunks))
+        chunks[i] = (chunks[i] + 1) // 2
+    return tuple(chunks)
+
+
+@dataclass
+class DatasetStatistics:
+    """
+    Value range of a data set, accumulated block by block. Missing values, i.e. NaN or the _FillValue of the source,
+    are counted and excluded from the range. The range is NaN if all values are missing.
+    """
+    minimum: float = np.nan
+    maximum: float = np.nan
+    nan_count: int = 0
+
+    def update(self, block: np.ndarray, fill_value=None) -> None:
+        if fill_value is not None:
+            block = np.where(block == fill_value, np.nan, block)
+        if block.dtype.kind == 'f':
+            self.nan_count += int(np.count_nonzero(np.isnan(block)))
+        if block.size == 0:
+            return
+        # fmin/fmax ignore NaN unless all values are NaN, without the warnings of nanmin/nanmax
+        self.minimum = float(np.fmin(self.minimum, np.fmin.reduce(block, axis=None)))
+        self.maximum = float(np.fmax(self.maximum, np.fmax.reduce(block, axis=None)))
+
+
+def _fill_value(source):
+    # Fill value of both HDF5 (NetCDF4) and pydap variables
+    attributes = getattr(source, 'attrs', None) or getattr(source, 'attributes', {})
+    fill_value = attributes.get('_FillValue')
+    return None if fill_value is None else np.asarray(fill_value).ravel()[0]
+
+
+def _fit_extent(n: int, align: int, budget: int) -> int:
+    # Largest extent that is either n or a multiple of align, and that does not exceed budget unless forced to
+    if budget >= n:
+        return n
+    return max(align, budget // align * align)
+
+
+def tile_ranges(shape: Tuple[int, int, int], itemsize: int, buffer_bytes: int, align: Tuple[int, int, int]
+                ) -> Iterator[Tuple[slice, slice, Iterator[slice]]]:
+    """
+    Splits a (nk, ni, nj) array into lateral (i, j) tiles, where each tile is further split into slabs along the first
+    axis. Each tile slab requires at most buffer_bytes bytes, unless a single aligned block exceeds the budget. Yields
+    the i and j slices of each tile, and an iterator over the k slices of the tile.
+
+    :param align: Block extents (k, i, j) that tile boundaries are aligned to, typically the chunk shapes of the data
+                  sets being read and written. Aligning avoids reading or rewriting the same chunk multiple times.
+    """
+    nk, ni, nj = shape
+    ak, ai, aj = (max(1, min(a, n)) for a, n in zip(align, shape))
+    cells = max(1, buffer_bytes // (itemsize * ak))
+    bj = _fit_extent(nj, aj, cells // ai)
+    bi = _fit_extent(ni, ai, cells // bj)
+    bk = _fit_extent(nk, ak, buffer_bytes // (itemsize * bi * bj))
+
+    def _k_slices():
+        for k0 in range(0, nk, bk):
+            yield slice(k0, min(k0 + bk, nk))
+
+    for i0 in range(0, ni, bi):
+        for j0 in range(0, nj, bj):
+            yield slice(i0, min(i0 + bi, ni)), slice(j0, min(j0 + bj, nj)), _k_slices()
+
+
+def aligned_blocks(*chunks: Optional[Tuple[int, ...]]) -> Tuple[int, ...]:
+    """
+    Smallest block shape that is a whole number of chunks for every given chunk shape. Missing (None) chunk shapes are
+    ignored.
+    """
+    chunks = [c for c in chunks if c is not None]
+    return tuple(int(np.lcm.reduce(c)) for c in zip(*chunks))
+
+
+def create_empty_dataset(out: h5py.File, target: str, shape: Tuple[int, ...], dtype, compression: str = 'gzip',
+                         compression_opts: Optional[int] = None) -> h5py.Dataset:
+    """
+    Creates a chunked data set where all values equal zero. No chunks are written, so the data set occupies virtually no
+    space neither in memory nor on disk.
+    """
+    dtype = np.dtype(dtype)
+    return out.create_dataset(
+        target, shape=shape, dtype=dtype, chunks=layer_chunks(shape, dtype.itemsize), compression=compression,
+        compression_opts=compression_opts, fillvalue=0
+    )
+
+
+def copy_dataset(source, out: h5py.File, target: str, buffer_bytes: int = DEFAULT_BUFFER_BYTES,
+                 compression: str = 'gzip', compression_opts: Optional[int] = None) -> DatasetStatistics:
+    """
+    Copies a data set into out[target] by reading and writing slabs along the first (time/K) axis. At most buffer_bytes
+    bytes of data are held in memory at any time, regardless of the size of the source. The output is re-chunked and
+    re-compressed on the way. The value range of the data set is computed from the same slabs and returned.
+
+    :param source:           An h5py data set or a pydap variable
+    :param out:              Destination HDF5 file
+    :param target:           Name of the data set in the destination file
+    :param buffer_bytes:     Memory budget for each slab
+    :param compression:      HDF5 compression filter of the output data set
+    :param compression_opts: Compression level of the output data set
+    """
+    shape = tuple(source.shape)
+    dtype = np.dtype(source.dtype)
+    ds = out.create_dataset(
+        target, shape=shape, dtype=dtype, chunks=layer_chunks(shape, dtype.itemsize), compression=compression,
+        compression_opts=compression_opts
+    )
+    statistics = DatasetStatistics()
+    fill_value = _fill_value(source)
+    for s in slab_ranges(shape, dtype.itemsize, buffer_bytes):
+        block = np.asarray(source[s])
+        ds[s] = block
+        statistics.update(block, fill_value)
+    # Carry over plain attributes, such as long_name
+    for key, value in getattr(source, 'attrs', {}).items():
+        if key not in _SKIPPED_ATTRIBUTES:
+            ds.attrs[key] = value
+    return statistics
+
+
+def read_transposed(ds: h5py.Dataset, selection: Tuple, axes: Tuple[int, ...], out: np.ndarray,
+                    mean_first_axis: bool = False, buffer_bytes: int = DEFAULT_BUFFER_BYTES) -> np.ndarray:
+    """
+    Reads the selection of ds into out, transposed by axes, without reading the selection into an intermediate array.
+    If the layout of out matches the data set, the values are read directly into out. Otherwise, the selection is read
+    in blocks along its slowest varying axis, which are transposed into out.
+
+    :param selection:       Integers and slices with positive step, one per axis of ds
+    :param axes:            Axes of the selection in the order of the axes of out, as for np.transpose
+    :param mean_first_axis: If True, the values are averaged along the first selected axis, which is not in axes
+    :param buffer_bytes:    Approximate size of each block
+    """
+    ranges = [range(*s.indices(n)) if isinstance(s, slice) else None for s, n in zip(selection, ds.shape)]
+    if any(r is not None and r.step < 0 for r in ranges):
+        raise ValueError('Negative steps are not supported')
+    dims = [d for d, r in enumerate(ranges) if r is not None]
+    shape = [len(ranges[d]) for d in dims]
+    reduced = 1 if mean_first_axis else 0
+    kept = shape[reduced:]
+    expected = tuple(kept[a] for a in axes)
+    if out.shape != expected:
+        raise ValueError(f'Output buffer has shape {out.shape}, expected {expected}')
+    if 0 in shape:
+        return out
+    if not mean_first_axis and axes == tuple(range(len(axes))) and out.flags.c_contiguous:
+        ds.read_direct(out, source_sel=tuple(selection))
+        return out
+    if len(kept) == 0:
+        out[()] = np.mean(ds[tuple(selection)])
+        return out
+    block_dim = dims[reduced]
+    block_range = ranges[block_dim]
+    row_bytes = ds.dtype.itemsize * int(np.prod(shape)) // kept[0]
+    step = max(1, buffer_bytes // max(1, row_bytes))
+    out_axis = axes.index(0)
+    buffer = None
+    for b0 in range(0, kept[0], step):
+        b1 = min(kept[0], b0 + step)
+        block_shape = list(shape)
+        block_shape[reduced] = b1 - b0
+        if buffer is None or list(buffer.shape) != block_shape:
+            buffer = np.empty(block_shape, dtype=ds.dtype)
+        block_selection = list(selection)
+        block_selection[block_dim] = slice(block_range[b0], block_range[b1 - 1] + 1, block_range.step)
+        ds.read_direct(buffer, source_sel=tuple(block_selection))
+        block = np.mean(buffer, axis=0) if mean_first_axis else buffer
+        index = [slice(None)] * out.ndim
+        index[out_axis] = slice(b0, b1)
+        out[tuple(index)] = block.transpose(axes)
+    return out
+
+
+def prefetch(items: Iterable[T], read: Callable[[T], R], read_ahead: int = 1) -> Iterator[R]:
+    """
+    Yields read(item) for each item, while the following read_ahead items are read in a background thread. Reads that
+    have not started are cancelled if the caller stops iterating. If read_ahead is 0, the items are read when requested.
+    """
+    assert read_ahead >= 0
+    if read_ahead == 0:
+        for item in items:
+            yield read(item)
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(read, item))
+                if len(pending) > read_ahead:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            for f in pending:
+                f.cancel()
@@ -0,0 +1,61 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import h5py
+
+
+class Hdf5FilePool:
+    """
+    Thread-safe pool of HDF5 files opened for reading, keyed by their resolved path. A file is opened on first use and
+    kept open until it is evicted or the pool is closed. When more than max_files files are open, the least recently
+    used file is closed. Data sets of a closed file become invalid, so max_files should exceed the number of files in
+    use at any time.
+
+    :param max_files:   Maximum number of files kept open
+    :param rdcc_nbytes: Size in bytes of the raw data chunk cache of each file. h5py default if None
+    :param rdcc_nslots: Number of chunk slots in the raw data chunk cache of each file. h5py default if None
+    :param rdcc_w0:     Chunk preemption policy of each file, between 0 and 1. h5py default if None
+    """
+
+    def __init__(self, max_files: int = 16, rdcc_nbytes: Optional[int] = None, rdcc_nslots: Optional[int] = None,
+                 rdcc_w0: Optional[float] = None) -> None:
+        assert max_files > 0
+        self._max_files = max_files
+        self._cache_settings = {
+            key: value
+            for key, value in (('rdcc_nbytes', rdcc_nbytes), ('rdcc_nslots', rdcc_nslots), ('rdcc_w0', rdcc_w0))
+            if value is not None
+        }
+        self._lock = threading.Lock()
+        self._files = OrderedDict()  # type: OrderedDict[str, h5py.File]
+
+    def get(self, path: str) -> h5py.File:
+        key = os.path.realpath(path)
+        with self._lock:
+            f = self._files.get(key)
+            if f is not None and f.id.valid:
+                self._files.move_to_end(key)
+                return f
+            f = h5py.File(key, mode='r', **self._cache_settings)
+            self._files[key] = f
+            while len(self._files) > self._max_files:
+                _, evicted = self._files.popitem(last=False)
+                evicted.close()
+            return f
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def __enter__(self) -> 'Hdf5FilePool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
@@ -1,12 +1,14 @@
+import os
 import pathlib
-import pydap.client
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import webob.exc
-from pydap.model import DatasetType
-from typing import List, Union
+from typing import List, Union, Optional, Tuple, Any, Dict
 
 import h5py
 import numpy as np
 
+from nrresqml.derivatives import h5streaming, opendap
 from nrresqml.derivatives.ijkgridcreator import IjkGridCreator, IjkGridCreationError
 from nrresqml.factories.energetics import create_hdf5_reference
 from nrresqml.factories.resqml.properties import create_continuous_property, create_categorical_property
@@ -33,13 +35,29 @@ class Hdf5ResQmlAdaptor:
         raise NotImplementedError('Method not implemented by subclass')
 
 
-def _open_delft3d_path(p: str) -> Union[h5py.File, DatasetType]:
+def _open_delft3d_path(p: str, remote_options: Optional[opendap.RemoteReadOptions] = None
+                       ) -> Union[h5py.File, opendap.RemoteFile]:
     if p.startswith('http'):
-        return pydap.client.open_url(p)
+        return opendap.open_remote(p, remote_options)
     else:
         return h5py.File(p, mode='r')
 
 
+def _stream_dataset_to_file(source_path: str, source_key: str, target_path: str, target: str, buffer_bytes: int,
+                            compression_level: Optional[int],
+                            remote_options: Optional[opendap.RemoteReadOptions] = None
+                            ) -> Tuple[str, h5streaming.DatasetStatistics]:
+    # Worker function for parallel processing of data sets. Opens its own handles to both the source and the target
+    source_file = _open_delft3d_path(source_path, remote_options)
+    try:
+        with h5py.File(target_path, 'w') as out:
+            statistics = h5streaming.copy_dataset(source_file[source_key], out, target, buffer_bytes,
+                                                  compression_opts=compression_level)
+    finally:
+        source_file.close()
+    return target_path, statistics
+
+
 class Delft3DResQmlAdaptor(Hdf5ResQmlAdaptor):
     _archel_map = {
         0: 'Inactive',
@@ -61,9 +79,9 @@ class Delft3DResQmlAdaptor(Hdf5ResQmlAdaptor):
     _delft3d_subenv_key = 'subenv'
     _resqml_archel_key = 'archel'
     _resqml_subenv_key = 'subenv'
-    # Continuous attributes and their natural bounds. We can compute the bounds per data set, but it is not obvious from
-    # the ResQML specification that it is required. Instead, we choose to use some natural bounds based on what the
-    # properties represents. This can save a significant amount of computation time.
+    # Continuous attributes and their natural bounds. The actual bounds are measured while data sets are streamed to the
+    # output file. The natural bounds are used when the data is not streamed (plain copies and links), since measuring
+    # would then require an additional pass over the data, and for properties where all values are missing.
     _cont_prop_bounds = {
         'DXX01': (0.0, 50.0),
         'DXX02': (0.0, 50.0),
@@ -91,17 +109,51 @@ class Delft3DResQmlAdaptor(Hdf5ResQmlAdaptor):
         'permeability': (0.0, 1.0),
     }
 
-    def __init__(self, d3_file: str, archel_file: str) -> None:
-        self._d3_file = _open_delft3d_path(d3_file)
+    def __init__(self, d3_file: str, archel_file: str, buffer_bytes: Optional[int] = None,
+                 compression_level: Optional[int] = None, pillar_storage: str = 'split',
+                 lattice_control_points: bool = False, workers: Optional[int] = None,
+                 link_source_data: bool = False, remote_options: Optional[opendap.RemoteReadOptions] = None
+                 ) -> None:
+        """
+        :param d3_file:           Path or OpenDAP url to the Delft3D file
+        :param archel_file:       Path or OpenDAP url to the file containing architectural elements/sub-environment
+        :param buffer_bytes:      Data sets are streamed to the output file in slabs along the time/K axis, using at most
+                                  buffer_bytes bytes of memory per slab. The data sets are re-chunked and re-compressed
+                                  on the way. h5streaming.DEFAULT_BUFFER_BYTES if None
+        :param compression_level: gzip compression level of the property data sets. h5py default if None
+        :param pillar_storage:    Storage format of the grid pillars. See IjkGridCreator.pillar_storage_formats
+        :param lattice_control_points: Represent the lateral grid geometry as a lattice if the grid is regular
+        :param workers:           If larger than one, data sets are streamed by this many worker processes in parallel,
+                                  while the grid geometry is written by the main process. Each worker uses a memory
+                                  budget of buffer_bytes (or h5streaming.DEFAULT_BUFFER_BYTES).
+        :param link_source_data:  If True, data sets are not copied. Instead, the output file contains HDF5 external
+                                  links to the data sets of the (local) source files. Only the grid geometry is written.
+                                  The output file is then only valid as long as the source files are kept in place.
+        :param remote_options:    Options for reading OpenDAP urls, such as the number of concurrent connections and
+                                  the slab cache. Ignored for local files
+        """
+        if link_source_data and any(f.startswith('http') for f in (d3_file, archel_file)):
+            raise AdaptorError('Linking source data is only supported for local files')
+        self._buffer_bytes = buffer_bytes
+        self._compression_level = compression_level
+        self._workers = workers or 1
+        self._link_source_data = link_source_data
+        self._d3_path = d3_file
+        self._archel_path = archel_file
+        self._remote_options = remote_options
+        # Statistics of the data sets that have been streamed to the output file, by target name
+        self._statistics = {}  # type: Dict[str, h5streaming.DatasetStatistics]
+        self._d3_file = _open_delft3d_path(d3_file, remote_options)
         try:
-            self._archel_file = _open_delft3d_path(archel_file)
+            self._archel_file = _open_delft3d_path(archel_file, remote_options)
         except (webob.exc.HTTPError, OSError):
             print(f'Architectural elements/sub-environment not defined: Failed to open file {archel_file}')
             self._archel_file = None
 
         # Grid handling
         try:
-            self._grid_creator = IjkGridCreator(self._d3_file)
+            self._grid_creator = IjkGridCreator(self._d3_file, pillar_storage, lattice_control_points,
+                                                buffer_bytes or h5streaming.DEFAULT_BUFFER_BYTES)
         except IjkGridCreationError as e:
             raise AdaptorError(f'Failed to create grid from {d3_file} with the following error:\n  ' + str(e))
 
@@ -126,11 +178,12 @@ class Delft3DResQmlAdaptor(Hdf5ResQmlAdaptor):
             except AttributeError:
                 long_name = p.attributes['long_name']
             pn = p.name.strip('/')
+            min_value, max_value = self._property_bounds(pn)
             props.append(create_continuous_property(
                 long_name,
                 pn,
-                self._cont_prop_bounds[pn][0],
-                self._cont_prop_bounds[pn][1],
+                min_value,
+                max_value,
                 ijk,
                 ref
             ))
@@ -144,29 +197,92 @@ class Delft3DResQmlAdaptor(Hdf5ResQmlAdaptor):
 
         return [ijk, ijk.Geometry.LocalCrs, ref] + props
 
-    def dump_h5_file(self, filename: pathlib.Path):
-        out = h5py.File(filename, 'w')
-        for p in self._continuous_properties:
-            out.copy(p, p.name)
-
-        # Define temporary function to extract archel data
-        def _copy_archel_data(source, target):
-            if self._archel_file is None or source not in self._archel_file:
-                nx, ny, nz = self._grid_creator.pillars.shape[-3:]
-                out.create_dataset(
-                    target, data=np.zeros((nz, nx, ny), dtype=np.float32), compression='gzip'
-                )
-            else:
-                out.copy(self._archel_file[source], target)
+    def _property_bounds(self, pn: str) -> Tuple[float, float]:
+        statistics = self._statistics.get(pn)
+        if statistics is None or np.isnan(statistics.minimum):
+            return self._cont_prop_bounds[pn]
+        return statistics.minimum, statistics.maximum
+
+    def _set_statistics(self, target: str, statistics: h5streaming.DatasetStatistics):
+        self._statistics[target.strip('/')] = statistics
+
+    def _copy_dataset(self, source, out: h5py.File, target: str):
+        # Data sets are always streamed, so that the value range of the properties is measured on the way
+        buffer_bytes = self._buffer_bytes or h5streaming.DEFAULT_BUFFER_BYTES
+        self._set_statistics(target, h5streaming.copy_dataset(
+            source, out, target, buffer_bytes, compression_opts=self._compression_level
+        ))
 
-        # Architectural elements data set (zero-array if key does not exist)
-        _copy_archel_data(self._delft3d_archel_key, self._resqml_archel_key)
+    def _create_zero_dataset(self, out: h5py.File, target: str):
+        nx, ny, nz = self._grid_creator.shape
+        if self._buffer_bytes is None and not self._link_source_data:
+            out.create_dataset(
+                target, data=np.zeros((nz, nx, ny), dtype=np.float32), compression='gzip',
+                compression_opts=self._compression_level
+            )
+        else:
+            h5streaming.create_empty_dataset(
+                out, target, (nz, nx, ny), np.float32, compression_opts=self._compression_level
+            )
 
-        # Sub-environment data set (zero-array if key does not exist)
-        _copy_archel_data(self._delft3d_subenv_key, self._resqml_subenv_key)
+    def _copy_datasets_parallel(self, copies: List[Tuple[str, Any, str]], out: h5py.File, filename: pathlib.Path):
+        buffer_bytes = self._buffer_bytes or h5streaming.DEFAULT_BUFFER_BYTES
+        # Each worker writes its data set to a temporary file next to the output file
+        with tempfile.TemporaryDirectory(dir=str(filename.parent)) as tmp_dir, \
+                ProcessPoolExecutor(self._workers) as pool:
+            futures = [
+                pool.submit(_stream_dataset_to_file, path, source.name, os.path.join(tmp_dir, f'{i}.h5'), target,
+                            buffer_bytes, self._compression_level, self._remote_options)
+                for i, (path, source, target) in enumerate(copies)
+            ]
+            # Write the grid geometry while the workers process the data sets
+            self._grid_creator.dump_grid_data(out)
+            # Collect the results in a deterministic order. The compressed chunks are copied as-is, so this is cheap
+            for future, (_, _, target) in zip(futures, copies):
+                tmp_file, statistics = future.result()
+                self._set_statistics(target, statistics)
+                with h5py.File(tmp_file, 'r') as tmp:
+                    out.copy(tmp[target], target)
+                os.remove(tmp_file)
 
-        # Dump data
+    def _link_datasets(self, copies: List[Tuple[str, Any, str]], out: h5py.File, filename: pathlib.Path):
+        out_dir = os.path.abspath(str(filename.parent))
+        for path, source, target in copies:
+            # Refer the source file relative to the output file, which is where HDF5 looks for it when resolving the
+            # link, unless that is impossible (e.g. different drives on Windows)
+            try:
+                link_path = os.path.relpath(os.path.abspath(path), out_dir)
+            except ValueError:
+                link_path = os.path.abspath(path)
+            out[target] = h5py.ExternalLink(link_path, source.name)
         self._grid_creator.dump_grid_data(out)
 
+    def dump_h5_file(self, filename: pathlib.Path):
+        """
+        Writes the data sets and the grid geometry to filename. Must be called before create_objects for the measured
+        property bounds to be used.
+        """
+        with h5py.File(filename, 'w') as out:
+            # Data sets to copy from the input files, given as (source file path, source data set, target name)
+            copies = [(self._d3_path, p, p.name) for p in self._continuous_properties]
+
+            # Architectural elements and sub-environment data sets (zero-array if key does not exist)
+            for source, target in ((self._delft3d_archel_key, self._resqml_archel_key),
+                                   (self._delft3d_subenv_key, self._resqml_subenv_key)):
+                if self._archel_file is None or source not in self._archel_file:
+                    self._create_zero_dataset(out, target)
+                else:
+                    copies.append((self._archel_path, self._archel_file[source], target))
+
+            if self._link_source_data:
+                self._link_datasets(copies, out, filename)
+            elif self._workers > 1:
+                self._copy_datasets_parallel(copies, out, filename)
+            else:
+                for _, source, target in copies:
+                    self._copy_dataset(source, out, target)
+                # Dump data
+                self._grid_creator.dump_grid_data(out)
+
     def h5_base_name(self) -> str:
         return 'Delft3d.h5'
@@ -1,17 +1,27 @@
 from dataclasses import dataclass
+from typing import Optional, Any, Callable
 
 import h5py
 import numpy as np
 
+from nrresqml.derivatives import h5streaming
 from nrresqml.factories.resqml.common import create_meta_data
 from nrresqml.factories.resqml.representations import create_local_depth_3d_crs
 from nrresqml.structures import xsd
 from nrresqml.structures.energetics import EpcExternalPartReference, Hdf5Dataset
 from nrresqml.structures.resqml.geometry import DoubleHdf5Array, Point3dHdf5Array, ParametricLineArray,\
-    Point3dParametricArray
+    Point3dParametricArray, Point3dLatticeArray, Point3dOffset, Point3d, AbstractPoint3dArray, DoubleConstantArray
 from nrresqml.structures.resqml.representations import IjkGridRepresentation, IjkGridGeometry, KDirection
 
 
+# Lattice index offsets (i, j) of the column corners that the four split pillars of a column are located at
+SPLIT_PILLAR_CORNERS = ((0, 0), (1, 0), (1, 1), (0, 1))
+
+
+# Approximate number of temporary arrays of slab size that are required when streaming pillars
+_STREAM_TEMPORARIES = 3
+
+
 class IjkGridCreationError(Exception):
     pass
 
@@ -23,9 +33,26 @@ class _GridParameters:
     nz: int
     dx: float
     dy: float
-    zz: np.ndarray
+    # Source data set (nz x nx x ny) of the pillar z values. The data set is not loaded, but streamed when needed
+    zz: Any
+    # True if zz is a temporal layer (DPS) that must be monotonized
+    monotonize: bool
     x0: float
     y0: float
+    regular: bool
+
+
+def _is_regular_grid(xcor: np.ndarray, ycor: np.ndarray, dx: float, dy: float) -> bool:
+    """
+    Checks if the corner coordinates describe an axis-aligned grid with constant spacing dx and dy
+    """
+    atol = 1e-3 * min(abs(dx), abs(dy))
+    return bool(
+        np.allclose(np.diff(xcor, axis=0), dx, rtol=0.0, atol=atol)
+        and np.allclose(np.diff(xcor, axis=1), 0.0, rtol=0.0, atol=atol)
+        and np.allclose(np.diff(ycor, axis=1), dy, rtol=0.0, atol=atol)
+        and np.allclose(np.diff(ycor, axis=0), 0.0, rtol=0.0, atol=atol)
+    )
 
 
 def _extract_grid_parameters(_d3_file: h5py.File) -> _GridParameters:
@@ -38,17 +65,16 @@ def _extract_grid_parameters(_d3_file: h5py.File) -> _GridParameters:
     if not {'DPS', 'zcor'}.intersection(_keys):
         raise IjkGridCreationError('Missing at least parameter "DPS" or "zcor"')
     # Extract parameters
-    xcor = _d3_file['xcor'] if 'xcor' in _keys else _d3_file['XCOR']
-    ycor = _d3_file['ycor'] if 'ycor' in _keys else _d3_file['YCOR']
+    xcor = np.asarray(_d3_file['xcor'] if 'xcor' in _keys else _d3_file['XCOR'])
+    ycor = np.asarray(_d3_file['ycor'] if 'ycor' in _keys else _d3_file['YCOR'])
     zcor = _d3_file['zcor'] if 'zcor' in _keys else _d3_file['DPS']
     nk, ni, nj = zcor.shape
     dx = (np.max(xcor) - np.min(xcor)) / (ni - 1)
     dy = (np.max(ycor) - np.min(ycor)) / (nj - 1)
-    zz = np.array(zcor)
-    if 'zcor' not in _d3_file:
-        # DPS was used, which is a temporal layer and may not be spatially feasible
-        zz = IjkGridCreator.mono_elevation(zz)
-    return _GridParameters(ni, nj, nk, dx, dy, zz, xcor[0, 0], ycor[0, 0])
+    # If DPS was used, it is a temporal layer and may not be spatially feasible
+    monotonize = 'zcor' not in _d3_file
+    regular = _is_regular_grid(xcor, ycor, dx, dy)
+    return _GridParameters(ni, nj, nk, dx, dy, zcor, monotonize, xcor[0, 0], ycor[0, 0], regular)
 
 
 def _hdf5_array(h5_epc_ref: EpcExternalPartReference, h5_path: str):
@@ -58,19 +84,42 @@ def _hdf5_array(h5_epc_ref: EpcExternalPartReference, h5_path: str):
 
 
 class IjkGridCreator:
-    def __init__(self, d3_file: h5py.File) -> None:
+    # Supported storage formats of the control point parameters (pillar elevations). 'split' stores four identical
+    # copies of each pillar, one per column corner. 'virtual' stores each pillar once and maps the four split pillar
+    # slots onto it using an HDF5 virtual data set.
+    pillar_storage_formats = ('split', 'virtual')
+
+    def __init__(self, d3_file: h5py.File, pillar_storage: str = 'split', lattice_control_points: bool = False,
+                 buffer_bytes: int = h5streaming.DEFAULT_BUFFER_BYTES) -> None:
         """
         Class used to create an IJK grid from a given data file. The file is expected to come from Delft 3D. This means
         that it is assumed to contain at least the variables DPS, XCOR and YCOR, which will be used to build the grid.
         Alternatively, zcor, xcor, ycor. Most importantly, it interprets the grid to have flat cell tops.
 
-        :param d3_file: A HDF5 file, imported by h5py
+        :param d3_file:                A HDF5 file, imported by h5py
+        :param pillar_storage:         Storage format of the pillars in the HDF5 file. One of pillar_storage_formats
+        :param lattice_control_points: If True, and the grid is regular, the lateral position of the pillars is
+                                       represented by a lattice instead of explicit control points in the HDF5 file
+        :param buffer_bytes:           Memory budget used when streaming the pillar z values to the HDF5 file
         """
+        if pillar_storage not in self.pillar_storage_formats:
+            raise IjkGridCreationError(f'Unknown pillar storage format "{pillar_storage}"')
+        self._pillar_storage = pillar_storage
+        self._buffer_bytes = buffer_bytes
         # Grid geometry data
         gp = _extract_grid_parameters(d3_file)
-        self._control_points = IjkGridCreator.pillarized_control_points(gp)
-        # Control point parameters. Describes each pillar as monotonized z values
-        self._control_point_parameters = IjkGridCreator.pillarize(gp.zz)
+        self._lattice: Optional[Point3dLatticeArray] = None
+        self._control_points: Optional[np.ndarray] = None
+        if lattice_control_points and gp.regular:
+            self._lattice = IjkGridCreator.lattice_control_points(gp)
+        else:
+            if lattice_control_points:
+                print('Grid is not regular, control points are stored explicitly')
+            self._control_points = IjkGridCreator.pillarized_control_points(gp)
+        # Source of the z values of each pillar (nz x nx x ny). The four split pillars of each column are identical, so
+        # the z values are only referred once. The values are streamed (and monotonized if needed) when written.
+        self._elevation = gp.zz
+        self._monotonize = gp.monotonize
 
     @property
     def _control_points_path(self):
@@ -78,17 +127,45 @@ class IjkGridCreator:
 
     @property
     def _control_point_parameters_path(self):
-        return f'control_point_parameters_{id(self._control_point_parameters)}'
+        return f'control_point_parameters_{id(self._elevation)}'
+
+    @property
+    def _pillar_elevation_path(self):
+        return f'pillar_elevation_{id(self._elevation)}'
+
+    @property
+    def shape(self):
+        """
+        Returns the shape (Nx, Ny, Nz) of the pillars
+        """
+        nk, ni, nj = self._elevation.shape
+        return ni, nj, nk
 
     @property
     def pillars(self) -> np.ndarray:
         """
         Returns the regularly spaced pillars that represents the grid as a Nx x Ny x Nz grid. The pillars are
-        monotonically increasing in the z-direction
+        monotonically increasing in the z-direction. NB! The pillars are computed and loaded into memory on every call
         :return:
         """
-        # With the current implementation, the pillars exactly match the control point parameters.
-        return self._control_point_parameters
+        pillars = np.empty(self.shape, dtype=self._elevation.dtype)
+
+        def _write(ks, is_, js, block):
+            pillars[is_, js, ks] = block.transpose((1, 2, 0))
+        self._stream_elevation(_write, None)
+        return pillars
+
+    def _stream_elevation(self, write: Callable[[slice, slice, slice, np.ndarray], None],
+                          target_chunks: Optional[tuple]):
+        align = h5streaming.aligned_blocks(getattr(self._elevation, 'chunks', None), target_chunks, (1, 1, 1))
+        if self._monotonize:
+            IjkGridCreator.mono_elevation_tiled(self._elevation, write, self._buffer_bytes, align)
+        else:
+            itemsize = np.dtype(self._elevation.dtype).itemsize
+            for is_, js, k_slices in h5streaming.tile_ranges(self._elevation.shape, itemsize, self._buffer_bytes,
+                                                             align):
+                for ks in k_slices:
+                    write(ks, is_, js, np.asarray(self._elevation[ks, is_, js]))
 
     def ijk_representation(self, h5_epc_ref: EpcExternalPartReference) -> IjkGridRepresentation:
         """
@@ -101,31 +178,72 @@ class IjkGridCreator:
         """
         # Create geometry
         crs = create_local_depth_3d_crs()
-        plane = Point3dHdf5Array(Hdf5Dataset(xsd.string(self._control_points_path), h5_epc_ref))
+        if self._lattice is not None:
+            plane: AbstractPoint3dArray = self._lattice
+            parameters_path = self._control_point_parameters_path
+        else:
+            plane = Point3dHdf5Array(Hdf5Dataset(xsd.string(self._control_points_path), h5_epc_ref))
+            parameters_path = self._control_points_path
         lines = ParametricLineArray(
             _hdf5_array(h5_epc_ref, self._control_point_parameters_path),
             plane
         )
-        points = Point3dParametricArray(_hdf5_array(h5_epc_ref, self._control_points_path), lines)
+        points = Point3dParametricArray(_hdf5_array(h5_epc_ref, parameters_path), lines)
         geom = IjkGridGeometry(crs, points, KDirection.up, xsd.boolean(True))
         # Create representation
         meta = create_meta_data('Delft 3D-based grid')
+        nk, ni, nj = self._elevation.shape
         rep = IjkGridRepresentation(
             **meta,
             Geometry=geom,
-            Nk=xsd.positiveInteger(self._control_point_parameters.shape[3]),
-            Ni=xsd.positiveInteger(self._control_point_parameters.shape[1]),
-            Nj=xsd.positiveInteger(self._control_point_parameters.shape[2])
+            Nk=xsd.positiveInteger(nk),
+            Ni=xsd.positiveInteger(ni),
+            Nj=xsd.positiveInteger(nj)
         )
         return rep
 
     def dump_grid_data(self, h5_file: h5py.File):
-        h5_file.create_dataset(
-            self._control_points_path, data=self._control_points, compression='gzip'
-        )
-        h5_file.create_dataset(
-            self._control_point_parameters_path, data=self._control_point_parameters, compression='gzip'
-        )
+        if self._control_points is not None:
+            h5_file.create_dataset(
+                self._control_points_path, data=self._control_points, compression='gzip'
+            )
+        shape = self.shape
+        dtype = np.dtype(self._elevation.dtype)
+        chunks = h5streaming.block_chunks(shape, dtype.itemsize)
+        # Limit the K extent of the chunks, so that slabs of complete layers aligned to the chunks fit within the memory
+        # budget when streaming
+        max_ck = self._buffer_bytes // (_STREAM_TEMPORARIES * dtype.itemsize * shape[0] * shape[1])
+        chunks = chunks[:2] + (max(1, min(chunks[2], max_ck)),)
+        # Chunk shape in the (k, i, j) order used when streaming
+        stream_chunks = (chunks[2], chunks[0], chunks[1])
+        if self._pillar_storage == 'virtual':
+            # Store the pillars once, and let all four split pillar slots refer to the same physical data set. The
+            # source file is given as '.', meaning the file containing the virtual data set, so that the HDF5 file can
+            # be moved or renamed freely.
+            shared = h5_file.create_dataset(
+                self._pillar_elevation_path, shape=shape, dtype=dtype, chunks=chunks, compression='gzip'
+            )
+
+            def _write(ks, is_, js, block):
+                shared[is_, js, ks] = block.transpose((1, 2, 0))
+            self._stream_elevation(_write, stream_chunks)
+            source = h5py.VirtualSource('.', shared.name, shape=shared.shape, dtype=shared.dtype)
+            layout = h5py.VirtualLayout(shape=(4,) + shape, dtype=shared.dtype)
+            for s in range(4):
+                layout[s] = source
+            h5_file.create_virtual_dataset(self._control_point_parameters_path, layout)
+        else:
+            # Write the block to each of the split pillars
+            cpp = h5_file.create_dataset(
+                self._control_point_parameters_path, shape=(4,) + shape, dtype=dtype, chunks=(1,) + chunks,
+                compression='gzip'
+            )
+
+            def _write(ks, is_, js, block):
+                bt = np.ascontiguousarray(block.transpose((1, 2, 0)))
+                for s in range(4):
+                    cpp[s, is_, js, ks] = bt
+            self._stream_elevation(_write, stream_chunks)
 
     @staticmethod
     def mono_elevation(depth: np.ndarray) -> np.ndarray:
@@ -141,19 +259,67 @@ class IjkGridCreator:
         truncated_elevation = np.maximum.accumulate(relative_elevation[::-1, :, :], axis=0)[::-1]
         return -truncated_elevation
 
+    @staticmethod
+    def mono_elevation_tiled(depth, write: Callable[[slice, slice, slice, np.ndarray], None],
+                             buffer_bytes: int = h5streaming.DEFAULT_BUFFER_BYTES, align: tuple = (1, 1, 1)):
+        """
+        Out-of-core equivalent of mono_elevation, yielding identical values. depth is streamed in lateral (i, j) tiles.
+        Each tile is read in slabs from the last to the first time step while keeping track of the running maximum, so
+        that memory usage is bounded by buffer_bytes regardless of the number of time steps.
+
+        :param depth:        DPS from Delft3D output file. A 3D data set (h5py, pydap or numpy) that supports slicing
+        :param write:        Function called as write(k_slice, i_slice, j_slice, block) for each monotonized block,
+                             where block has the shape (nk, ni, nj) of the sliced region
+        :param buffer_bytes: Approximate memory budget
+        :param align:        Block shape (k, i, j) that tiles are aligned to. See h5streaming.tile_ranges
+        """
+        itemsize = np.dtype(depth.dtype).itemsize
+        # Each slab requires a few temporary arrays of its own size
+        for is_, js, k_slices in h5streaming.tile_ranges(depth.shape, itemsize, buffer_bytes // _STREAM_TEMPORARIES,
+                                                         align):
+            base_depth = np.asarray(depth[0:1, is_, js])[0]
+            running_max = None
+            for ks in reversed(list(k_slices)):
+                relative_elevation = np.asarray(depth[ks, is_, js]) - base_depth
+                truncated_elevation = np.maximum.accumulate(relative_elevation[::-1, :, :], axis=0)[::-1]
+                if running_max is not None:
+                    np.maximum(truncated_elevation, running_max, out=truncated_elevation)
+                running_max = truncated_elevation[0].copy()
+                write(ks, is_, js, -truncated_elevation)
+
+    @staticmethod
+    def lattice_control_points(gp: _GridParameters) -> Point3dLatticeArray:
+        """
+        Describes the lateral position of the pillars as a two-dimensional lattice of the (nx + 1) x (ny + 1) column
+        corners, with one offset per axis. Node (i, j) is located at Origin + (i * dx, j * dy). Column (i, j) has its
+        split pillars located at the lattice nodes given by SPLIT_PILLAR_CORNERS.
+        """
+        origin = Point3d(xsd.double(gp.x0), xsd.double(gp.y0), xsd.double(0.0))
+        offsets = [
+            Point3dOffset(
+                Point3d(xsd.double(gp.dx), xsd.double(0.0), xsd.double(0.0)),
+                DoubleConstantArray(xsd.double(1.0), xsd.positiveInteger(gp.nx))
+            ),
+            Point3dOffset(
+                Point3d(xsd.double(0.0), xsd.double(gp.dy), xsd.double(0.0)),
+                DoubleConstantArray(xsd.double(1.0), xsd.positiveInteger(gp.ny))
+            ),
+        ]
+        return Point3dLatticeArray(xsd.boolean(True), origin, offsets)
+
     @staticmethod
     def pillarized_control_points(gp: _GridParameters):
-        cp = np.ndarray((4, gp.nx, gp.ny, 3), dtype=np.float)
+        cp = np.ndarray((4, gp.nx, gp.ny, 3), dtype=np.float64)
         xx, yy = np.meshgrid(np.arange(gp.nx + 1) * gp.dx, np.arange(gp.ny + 1) * gp.dy, indexing='ij')
         # Control points. Describes the lateral distribution of pillars
         cp[0, :, :, 0] = xx[:-1, :-1]
         cp[1, :, :, 0] = xx[1:, :-1]
         cp[2, :, :, 0] = xx[1:, 1:]
-        cp[3, :, :, 0] = xx[-1:, 1:]
+        cp[3, :, :, 0] = xx[:-1, 1:]
         cp[0, :, :, 1] = yy[:-1, :-1]
         cp[1, :, :, 1] = yy[1:, :-1]
         cp[2, :, :, 1] = yy[1:, 1:]
-        cp[3, :, :, 1] = yy[-1:, 1:]
+        cp[3, :, :, 1] = yy[:-1, 1:]
 
         # Add reference and set z-value to nan
         cp[:, :, :, 0] += gp.x0
@@ -0,0 +1,252 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Tuple, Callable, Any, Dict, List
+
+import numpy as np
+import pydap.client
+from pydap.model import DatasetType, GridType
+
+
+@dataclass
+class RemoteReadOptions:
+    """
+    Options for reading Delft3D data from an OpenDAP server
+
+    :param connections: Maximum number of concurrent requests to the server
+    :param retries:     Number of times a failed request is retried before giving up
+    :param retry_delay: Delay in seconds before the first retry. The delay is doubled for each subsequent retry
+    :param slab_bytes:  Approximate size of each request. Variables are fetched in slabs of complete layers along the
+                        first (time/K) axis
+    :param cache_dir:   Directory where fetched slabs are cached. If None, slabs are cached in memory only for the
+                        lifetime of the opened file
+    :param cache_bytes: Maximum size of the slab cache. The least recently used slabs are evicted first
+    """
+    connections: int = 4
+    retries: int = 3
+    retry_delay: float = 1.0
+    slab_bytes: int = 16 * 2 ** 20
+    cache_dir: Optional[str] = None
+    cache_bytes: int = 2 ** 30
+
+
+class SlabCache:
+    """
+    Cache of array slabs with size-based LRU eviction. Slabs are stored as .npy files in a directory, or in memory if
+    no directory is given. The directory may be shared between processes and between conversions.
+    """
+
+    def __init__(self, directory: Optional[str], max_bytes: int) -> None:
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Maps a key (file path or slab key) to the size of the entry, ordered from least to most recently used
+        self._entries = OrderedDict()  # type: OrderedDict[str, int]
+        self._memory = {}  # type: Dict[str, np.ndarray]
+        self._total = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            files = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.npy')]
+            for f in sorted(files, key=os.path.getmtime):
+                self._entries[f] = os.path.getsize(f)
+                self._total += self._entries[f]
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        if self._directory is None:
+            return digest
+        return os.path.join(self._directory, digest + '.npy')
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self._path(key)
+        with self._lock:
+            if self._directory is None:
+                if path not in self._memory:
+                    return None
+                self._entries.move_to_end(path)
+                return self._memory[path]
+            try:
+                data = np.load(path)
+                os.utime(path)
+            except (OSError, ValueError):
+                # Missing (e.g. evicted by another process) or incomplete file
+                self._total -= self._entries.pop(path, 0)
+                return None
+            if path in self._entries:
+                self._entries.move_to_end(path)
+            return data
+
+    def put(self, key: str, data: np.ndarray) -> None:
+        path = self._path(key)
+        with self._lock:
+            if self._directory is None:
+                self._memory[path] = data
+            else:
+                # Write to a temporary file first, so that other processes never see a partially written slab
+                tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, data)
+                os.replace(tmp_path, path)
+            size = data.nbytes if self._directory is None else os.path.getsize(path)
+            self._total -= self._entries.pop(path, 0)
+            self._entries[path] = size
+            self._total += size
+            self._evict()
+
+    def _evict(self) -> None:
+        # Never evict the most recent entry, even if it alone exceeds the budget
+        while self._total > self._max_bytes and len(self._entries) > 1:
+            path, size = self._entries.popitem(last=False)
+            self._total -= size
+            if self._directory is None:
+                del self._memory[path]
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def _expand_key(key: Any, ndim: int) -> Tuple[Any, ...]:
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        i = next(i for i, k in enumerate(key) if k is Ellipsis)
+        key = key[:i] + (slice(None),) * (ndim - len(key) + 1) + key[i + 1:]
+    return key + (slice(None),) * (ndim - len(key))
+
+
+class RemoteDataset:
+    """
+    Read-only proxy of an OpenDAP variable. Reads are split into slabs of complete layers along the first axis, which
+    are fetched concurrently and cached. Supports the subset of the h5py.Dataset interface used by the converter.
+    """
+
+    def __init__(self, remote_file: 'RemoteFile', variable) -> None:
+        self._file = remote_file
+        # Grid variables carry their coordinate maps along. Only the data array is of interest
+        self._variable = variable.array if isinstance(variable, GridType) else variable
+        self.name = variable.name
+        self.attributes = variable.attributes
+        self.shape = tuple(self._variable.shape)
+        self.dtype = np.dtype(self._variable.dtype)
+        layer_bytes = self.dtype.itemsize * int(np.prod(self.shape[1:]))
+        self._slab_size = max(1, self._file.options.slab_bytes // max(layer_bytes, 1))
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def chunks(self) -> Optional[Tuple[int, ...]]:
+        # Reporting the slabs as chunks makes block-wise readers align with the requests
+        if self.ndim == 0:
+            return None
+        return (min(self._slab_size, max(1, self.shape[0])),) + self.shape[1:]
+
+    def _fetch_slab(self, index: int) -> np.ndarray:
+        k0 = index * self._slab_size
+        k1 = min(k0 + self._slab_size, self.shape[0])
+        key = f'{self._file.url}|{self.name}|{self.shape}|{self.dtype.str}|{k0}:{k1}'
+        data = self._file.cache.get(key)
+        if data is None:
+            data = self._file.fetch(self._variable, (slice(k0, k1),))
+            self._file.cache.put(key, data)
+        return data
+
+    def __getitem__(self, key) -> np.ndarray:
+        if self.ndim == 0:
+            return self._file.fetch(self._variable, ())
+        key = _expand_key(key, self.ndim)
+        first, rest = key[0], key[1:]
+        if isinstance(first, slice):
+            indices = np.arange(*first.indices(self.shape[0]))
+        else:
+            indices = np.arange(self.shape[0])[first]
+        if indices.size == 0:
+            return np.empty((0,) + self.shape[1:], dtype=self.dtype)[(slice(None),) + rest]
+        slabs = range(int(indices.min()) // self._slab_size, int(indices.max()) // self._slab_size + 1)
+        data = np.concatenate(self._file.map(self._fetch_slab, slabs), axis=0)
+        offset = slabs[0] * self._slab_size
+        if isinstance(first, slice):
+            data = data[indices - offset]
+        else:
+            # Integer (or array) index along the first axis, relative to the first fetched slab
+            data = data[np.asarray(first) % self.shape[0] - offset]
+        if data.ndim == self.ndim:
+            return data[(slice(None),) + rest]
+        return data[rest]
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+
+class RemoteFile:
+    """
+    Read-only proxy of an OpenDAP data set. Supports the subset of the h5py.File interface used by the converter.
+
+    :param url:     OpenDAP url of the data set
+    :param options: Read options. Defaults are used if None
+    :param dataset: Already opened pydap data set. If None, the data set is opened from url
+    :param fetch:   Function fetching a hyperslab, given a pydap variable and a tuple of slices. Can be replaced, e.g.
+                    for testing against a local server. Defaults to reading the variable through pydap
+    """
+
+    def __init__(self, url: str, options: Optional[RemoteReadOptions] = None, dataset: Optional[DatasetType] = None,
+                 fetch: Optional[Callable[[Any, Tuple[slice, ...]], np.ndarray]] = None) -> None:
+        self.url = url
+        self.options = options or RemoteReadOptions()
+        self.cache = SlabCache(self.options.cache_dir, self.options.cache_bytes)
+        self._dataset = dataset if dataset is not None else pydap.client.open_url(url)
+        self._fetch = fetch or _fetch_hyperslab
+        self._pool = ThreadPoolExecutor(max(1, self.options.connections))
+        self._variables = {}  # type: Dict[str, RemoteDataset]
+
+    def keys(self):
+        return self._dataset.keys()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._dataset.keys()
+
+    def __getitem__(self, key: str) -> RemoteDataset:
+        key = key.strip('/')
+        if key not in self._variables:
+            if key not in self:
+                raise KeyError(key)
+            self._variables[key] = RemoteDataset(self, self._dataset[key])
+        return self._variables[key]
+
+    def map(self, function: Callable[[int], np.ndarray], indices) -> List[np.ndarray]:
+        indices = list(indices)
+        if len(indices) == 1:
+            return [function(indices[0])]
+        return list(self._pool.map(function, indices))
+
+    def fetch(self, variable, key: Tuple[slice, ...]) -> np.ndarray:
+        """ Fetches a hyperslab of a variable, retrying with an increasing delay if the request fails """
+        delay = self.options.retry_delay
+        for attempt in range(self.options.retries + 1):
+            try:
+                return np.asarray(self._fetch(variable, key))
+            except Exception as e:
+                if attempt == self.options.retries:
+                    raise
+                print(f'Request for {variable.name} failed ({e}). Retrying in {delay} s')
+                time.sleep(delay)
+                delay *= 2
+
+    def close(self) -> None:
+        self._pool.shutdown()
+
+
+def _fetch_hyperslab(variable, key: Tuple[slice, ...]) -> np.ndarray:
+    return np.asarray(variable[key] if len(key) > 0 else variable[...])
+
+
+def open_remote(url: str, options: Optional[RemoteReadOptions] = None) -> RemoteFile:
+    return RemoteFile(url, options)
@@ -0,0 +1,248 @@
+import pathlib
+from dataclasses import dataclass
+from typing import Tuple, Iterable, Iterator, List, Optional
+
+import h5py
+import numpy as np
+
+from nrresqml.derivatives import h5streaming
+from nrresqml.derivatives.dataextraction import lattice_origin_and_spacing, has_shared_split_pillars
+from nrresqml.derivatives.h5arrayview import Hdf5ArrayView
+from nrresqml.derivatives.h5streaming import DEFAULT_BUFFER_BYTES
+from nrresqml.resqml import ResQml
+from nrresqml.structures.resqml.geometry import Point3dLatticeArray
+from nrresqml.structures.resqml.representations import IjkGridRepresentation
+
+
+# Data set types that are transferred to RMS as discrete properties
+DISCRETE_DTYPES = (np.uint8, np.uint16)
+
+
+@dataclass
+class RmsPillars:
+    """
+    Pillar geometry of a grid in the format of RMS corner point grids (roxar.grids.CornerPointGridGeometry). The data of
+    pillar (i, j) is set by cpg.set_pillar_data(i, j, bottom[i, j], top[i, j], z[i, j]).
+
+    :param x0:      x coordinate of the first pillar
+    :param y0:      y coordinate of the first pillar
+    :param dx:      Pillar spacing along I
+    :param dy:      Pillar spacing along J
+    :param z:       Masked array of shape (nx + 1, ny + 1, 4, nz) with the z values of the four corners of each pillar.
+                    Corners without an adjacent cell are masked
+    :param bottom:  Array of shape (nx + 1, ny + 1, 3) with the bottom point (x, y, min z) of each pillar. The z value
+                    is NaN if all corners of the pillar are masked
+    :param top:     Array of shape (nx + 1, ny + 1, 3) with the top point (x, y, max z) of each pillar
+    """
+    x0: float
+    y0: float
+    dx: float
+    dy: float
+    z: np.ma.MaskedArray
+    bottom: np.ndarray
+    top: np.ndarray
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """ Number of cells along I and J, and number of pillar nodes along K, i.e. (nx, ny, nz) """
+        return self.z.shape[0] - 1, self.z.shape[1] - 1, self.z.shape[3]
+
+
+def _fill_flat(z: np.ndarray, i0: int, i1: int, block: np.ndarray):
+    # Flat cell tops. Each of the four corners of the pillars surrounding a cell has the elevation of the cell
+    z[i0 + 1:i1 + 1, 1:, 0] = block
+    z[i0:i1, 1:, 1] = block
+    z[i0 + 1:i1 + 1, :-1, 2] = block
+    z[i0:i1, :-1, 3] = block
+
+
+def _fill_smooth(z: np.ndarray, i0: int, i1: int, block: np.ndarray):
+    # Smooth cell tops. This effectively shifts the grid half a cell in I and J direction
+    nx, ny = z.shape[0] - 1, z.shape[1] - 1
+    c0 = max(i0, 1)
+    z[c0:i1, 1:-1, 0] = block[c0 - i0:, 1:]
+    z[i0:i1, 1:-1, 1] = block[:, 1:]
+    z[c0:i1, :-1, 2] = block[c0 - i0:, :]
+    z[i0:i1, :-1, 3] = block
+    # Pillars on the upper boundaries
+    c1 = min(i1, nx - 1)
+    z[i0 + 1:c1 + 1, ny, 0] = block[:c1 - i0, -1]
+    z[i0:i1, ny, 1] = block[:, -1]
+    if i1 == nx:
+        z[nx, 1:, 0] = block[-1, :]
+        z[nx, :-1, 2] = block[-1, :]
+
+
+def rms_pillars(elevation, x0: float, y0: float, dx: float, dy: float, smooth_approximation: bool = False,
+                buffer_bytes: int = DEFAULT_BUFFER_BYTES) -> RmsPillars:
+    """
+    Creates the RMS pillar geometry of a grid with flat cell tops. The elevation is read in blocks along I, so that
+    lazy sources (h5py.Dataset, Hdf5ArrayView) are never read in full at once.
+
+    :param elevation:            Array-like of shape (nx, ny, nz) with the elevation of the cells (i, j) at each of the
+                                 nz pillar nodes
+    :param x0:                   x coordinate of the first pillar
+    :param y0:                   y coordinate of the first pillar
+    :param dx:                   Pillar spacing along I
+    :param dy:                   Pillar spacing along J
+    :param smooth_approximation: If True, cell tops are continuous instead of flat. This is an approximation that
+                                 effectively shifts the grid half a cell in the I and J directions
+    :param buffer_bytes:         Approximate memory budget of each block, in addition to the returned arrays
+    """
+    nx, ny, nz = elevation.shape
+    z = np.full((nx + 1, ny + 1, 4, nz), fill_value=np.nan, dtype=np.float64)
+    fill = _fill_smooth if smooth_approximation else _fill_flat
+    # Rows of cells per block. The block is transposed to (i, j, corner, k) when assigned
+    row_bytes = 2 * np.dtype(np.float64).itemsize * max(1, ny * nz)
+    step = max(1, buffer_bytes // row_bytes)
+    for i0 in range(0, nx, step):
+        i1 = min(nx, i0 + step)
+        block = np.asarray(elevation[i0:i1], dtype=np.float64)
+        fill(z, i0, i1, block)
+    # Top and bottom point of each pillar, ignoring corners without an adjacent cell
+    xx, yy = np.meshgrid(x0 + np.arange(nx + 1) * dx, y0 + np.arange(ny + 1) * dy, indexing='ij')
+    bottom = np.stack([xx, yy, np.empty_like(xx)], axis=-1)
+    top = bottom.copy()
+    for p0 in range(0, nx + 1, step):
+        p1 = min(nx + 1, p0 + step)
+        values = z[p0:p1].reshape(p1 - p0, ny + 1, 4 * nz)
+        bottom[p0:p1, :, 2] = np.fmin.reduce(values, axis=2)
+        top[p0:p1, :, 2] = np.fmax.reduce(values, axis=2)
+    return RmsPillars(x0, y0, dx, dy, np.ma.array(z, mask=np.isnan(z)), bottom, top)
+
+
+def pillar_elevation(data: h5py.File) -> Hdf5ArrayView:
+    """
+    Lazy view of the pillar elevations of the (single) grid of an HDF5 file written by nrresqml, of shape (nx, ny, nz).
+    The split pillars are flattened. If they are virtual copies of a single data set, only one of them is read.
+    """
+    cpp_key = [c for c in data.keys() if c.startswith('control_point_parameters')][0]
+    cpp = data[cpp_key]
+    if cpp.ndim == 4 and cpp.shape[0] == 4:
+        if has_shared_split_pillars(cpp):
+            # The split pillars are virtual copies of a single pillar data set, reading one of them is sufficient
+            return Hdf5ArrayView(cpp)[0]
+        return Hdf5ArrayView(cpp, mean_axis=0)
+    # Shared pillar format, stored as (nz, nx, ny)
+    return Hdf5ArrayView(cpp).transpose(1, 2, 0)
+
+
+def read_lattice(epc_file: str) -> Optional[Point3dLatticeArray]:
+    """
+    Reads the lattice describing the lateral position of the pillars of the (single) grid of a ResQml database, or None
+    if the control points are stored explicitly in the HDF5 file
+    """
+    with ResQml.read_zipped(pathlib.Path(epc_file), lazy=True) as rq:
+        grids = list(rq.objects(IjkGridRepresentation))
+        assert len(grids) == 1  # Multiple grids are not supported
+        control_points = grids[0].Geometry.Points.ParametricLines.ControlPoints
+    return control_points if isinstance(control_points, Point3dLatticeArray) else None
+
+
+def _pillar_origin_and_spacing(data: h5py.File, i0: int, j0: int, lattice: Optional[Point3dLatticeArray]
+                               ) -> Tuple[float, float, float, float]:
+    # Position of pillar (i0, j0) and the spacing to its neighbours along I and J
+    cps_keys = [c for c in data.keys() if c.startswith('control_points')]
+    if len(cps_keys) == 0:
+        # The lateral geometry is represented as a lattice, which is only described by the ResQml objects
+        if lattice is None:
+            raise ValueError('The grid has no control points in the HDF5 file, the lattice must be provided')
+        x0, y0, dx, dy = lattice_origin_and_spacing(lattice)
+        return x0 + i0 * dx, y0 + j0 * dy, dx, dy
+    cps = Hdf5ArrayView(data[cps_keys[0]])
+    if cps.ndim == 4:
+        cps = cps[0]
+    p00, p10, p01 = cps[i0, j0].read(), cps[i0 + 1, j0].read(), cps[i0, j0 + 1].read()
+    return p00[0], p00[1], p10[0] - p00[0], p01[1] - p00[1]
+
+
+def read_rms_pillars(data: h5py.File, xy_buffer: int = 1, smooth_approximation: bool = False,
+                     k_slice: slice = slice(None), buffer_bytes: int = DEFAULT_BUFFER_BYTES,
+                     lattice: Optional[Point3dLatticeArray] = None) -> RmsPillars:
+    """
+    Reads the RMS pillar geometry of the (single) grid of an HDF5 file written by nrresqml. See rms_pillars
+
+    :param xy_buffer:   Number of cells cropped from each lateral boundary of the grid
+    :param k_slice:     Pillar nodes to include along K. Only positive steps are supported
+    :param lattice:     Lattice of the lateral pillar positions (see read_lattice). Required if the grid was converted
+                        with lattice control points, which are not stored in the HDF5 file
+    """
+    elevation = pillar_elevation(data)
+    xy_slice = slice(xy_buffer, -xy_buffer) if xy_buffer > 0 else slice(None)
+    elevation = elevation[xy_slice, xy_slice, k_slice]
+    x0, y0, dx, dy = _pillar_origin_and_spacing(data, xy_buffer, xy_buffer, lattice)
+    return rms_pillars(elevation, x0, y0, dx, dy, smooth_approximation, buffer_bytes)
+
+
+@dataclass
+class RmsProperty:
+    """
+    Values of a grid property in the order of RMS grid properties, ready for roxar's set_values
+
+    :param name:        Name of the HDF5 data set
+    :param discrete:    True if the property is discrete. Discrete values keep the dtype of the data set, continuous
+                        values are float32
+    :param values:      Values of the cells, flattened from (i, j, k) order, i.e. with k varying fastest
+    """
+    name: str
+    discrete: bool
+    values: np.ndarray
+
+
+def rms_property_names(data: h5py.File) -> List[str]:
+    """ Names of the data sets of an HDF5 file written by nrresqml that are properties of the (single) grid """
+    elevation = pillar_elevation(data)
+    shape = tuple(elevation.shape[a] for a in (2, 0, 1))
+    return [
+        name for name, ds in data.items()
+        if isinstance(ds, h5py.Dataset) and ds.shape == shape
+        and not name.startswith(('control_point', 'pillar_elevation'))
+    ]
+
+
+def _layer_slice(nk: int, k_slice: slice) -> slice:
+    # The cell layers between the selected pillar nodes. Pillar nodes k_slice yield one layer less than the number of
+    # nodes, so the last node does not start a layer
+    nodes = range(nk)[k_slice]
+    if nodes.step < 0:
+        raise ValueError('Negative steps are not supported')
+    if len(nodes) < 2:
+        return slice(0, 0)
+    return slice(nodes.start, nodes[-1], nodes.step)
+
+
+def read_rms_property(data: h5py.File, name: str, xy_buffer: int = 1, k_slice: slice = slice(None),
+                      buffer_bytes: int = DEFAULT_BUFFER_BYTES) -> RmsProperty:
+    """
+    Reads a grid property in the order of RMS grid properties. Only the cropped hyperslab is read, and it is converted
+    and transposed into the returned buffer without further intermediate copies of the property.
+
+    :param xy_buffer:   Number of cells cropped from each lateral boundary of the grid. See read_rms_pillars
+    :param k_slice:     Pillar nodes to include along K. See read_rms_pillars. The property is read for the layers
+                        between the nodes
+    """
+    ds = data[name]
+    nk, ni, nj = ds.shape
+    discrete = ds.dtype in DISCRETE_DTYPES
+    xy = slice(xy_buffer, -xy_buffer) if xy_buffer > 0 else slice(None)
+    selection = (_layer_slice(nk, k_slice), xy, xy)
+    shape = tuple(len(range(n)[s]) for s, n in zip(selection, ds.shape))
+    values = np.empty((shape[1], shape[2], shape[0]), dtype=ds.dtype if discrete else np.float32)
+    h5streaming.read_transposed(ds, selection, (1, 2, 0), values, buffer_bytes=buffer_bytes)
+    return RmsProperty(name, discrete, values.reshape(-1))
+
+
+def iterate_rms_properties(data: h5py.File, names: Optional[Iterable[str]] = None, xy_buffer: int = 1,
+                           k_slice: slice = slice(None), read_ahead: int = 1,
+                           buffer_bytes: int = DEFAULT_BUFFER_BYTES) -> Iterator[RmsProperty]:
+    """
+    Iterates the grid properties of an HDF5 file written by nrresqml in the order of RMS grid properties. The next
+    properties are read in a background thread while the caller transfers the current one. See read_rms_property
+
+    :param names:       Names of the properties. All grid properties (see rms_property_names) if None
+    :param read_ahead:  Number of properties read ahead of the current one. 0 disables the background thread
+    """
+    names = rms_property_names(data) if names is None else list(names)
+    yield from h5streaming.prefetch(
+        names, lambda name: read_rms_property(data, name, xy_buffer, k_slice, buffer_bytes), read_ahead
+    )
@@ -1,11 +1,14 @@
+import io
 import os
 import pathlib
 import shutil
-from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, IO, List, Tuple
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
 
 from lxml import etree
 
-from nrresqml.serialization import elementify
+from nrresqml.serialization import elementify, manifest
 from nrresqml.derivatives.hdf5resqmladaptor import Hdf5ResQmlAdaptor
 from nrresqml.resqml import ResQml
 from nrresqml.structures import contenttypes, xsd
@@ -22,10 +25,37 @@ def _create_cache_folder(cache_dir: pathlib.Path):
     os.makedirs(str(cache_dir / 'docProps'))
 
 
+def _write_xml(fh: IO[bytes], el: etree.Element, standalone: Optional[bool], pretty_print: bool):
+    # Used both when writing directly to the package and when serializing to bytes in worker processes. This ensures
+    # that the output is identical regardless of how the package is written.
+    with etree.xmlfile(fh, encoding='UTF-8') as xf:
+        xf.write_declaration(standalone=standalone)
+        xf.write(el, pretty_print=pretty_print)
+
+
+def _relationships_part_name(obj: AbstractObject) -> str:
+    return (pathlib.Path(_RELS_DIR) / (obj.base_name() + '.rels')).as_posix()
+
+
 class _Cacher:
-    def __init__(self, save_path: pathlib.Path, zip_mode: bool) -> None:
+    """
+    Writes the parts of an EPC package, either into a zip file (the .epc file) or as plain files in a directory. In zip
+    mode, a single handle to the zip file is held until the cacher is closed, and each part is streamed directly into
+    it. Use as a context manager to ensure that the package is finalized.
+
+    :param save_path:         Path of the EPC package
+    :param zip_mode:          Write a zip file if True, otherwise a directory
+    :param compression_level: Deflate compression level (0-9) of the parts in zip mode. If None, parts are stored
+                              uncompressed
+    :param pretty_print:      Indent the XML of each part. Compact XML is smaller and faster to write
+    """
+
+    def __init__(self, save_path: pathlib.Path, zip_mode: bool, compression_level: Optional[int] = None,
+                 pretty_print: bool = True) -> None:
         self._zip_mode = zip_mode
+        self._pretty_print = pretty_print
         self._epc_file_path = save_path.with_suffix('.epc')
+        self._zip_file = None
         # Initialize folders
         if not zip_mode:
             # Will throw if folder already exists
@@ -35,84 +65,152 @@ class _Cacher:
             os.makedirs(str(self._epc_file_path.parent), exist_ok=True)
             if self._epc_file_path.is_file():
                 os.remove(str(self._epc_file_path))
+            if compression_level is None:
+                self._zip_file = ZipFile(self._epc_file_path, 'w', ZIP_STORED)
+            else:
+                self._zip_file = ZipFile(self._epc_file_path, 'w', ZIP_DEFLATED, compresslevel=compression_level)
 
-    def _handle(self, base_name: str):
+    def __enter__(self) -> '_Cacher':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def close(self):
+        if self._zip_file is not None:
+            self._zip_file.close()
+            self._zip_file = None
+
+    def _handle(self, base_name: str) -> IO[bytes]:
         if self._zip_mode:
-            return ZipFile(self._epc_file_path, 'a').open(base_name, 'w')
+            return self._zip_file.open(base_name, 'w')
         else:
-            return str(self._epc_file_path / base_name)
+            return open(str(self._epc_file_path / base_name), 'wb')
+
+    def _write_xml(self, base_name: str, el: etree.Element, standalone: Optional[bool] = None):
+        with self._handle(base_name) as fh:
+            _write_xml(fh, el, standalone, self._pretty_print)
+
+    def dump_part(self, base_name: str, data: bytes):
+        """ Writes a part that has already been serialized, e.g. by _serialize_parts """
+        with self._handle(base_name) as fh:
+            fh.write(data)
 
     def dump_epc_object(self, obj: AbstractObject, el: etree.Element):
-        tree_obj = etree.ElementTree(el)
-        base_name = obj.base_name()
-        fh = self._handle(base_name)
-        tree_obj.write(fh, pretty_print=True, encoding='utf-8', xml_declaration=True)
+        self._write_xml(obj.base_name(), el)
 
     def dump_relationships(self, obj: AbstractObject, rels: Relationships):
         el = elementify.elementify(rels, [], None)
-        tree_obj = etree.ElementTree(el)
-        fn = pathlib.Path(_RELS_DIR) / (obj.base_name() + '.rels')
-        fh = self._handle(str(fn))
-        tree_obj.write(fh, pretty_print=True, standalone=False, encoding='utf-8')
+        self._write_xml(_relationships_part_name(obj), el, standalone=False)
 
     def dump_content_types(self, ct: contenttypes.Types):
         el = elementify.elementify(ct, [], None)
-        tree = etree.ElementTree(el)
-        fh = self._handle('[ContentTypes].xml')
-        tree.write(fh, pretty_print=True, standalone=False, encoding='utf-8')
+        self._write_xml('[ContentTypes].xml', el, standalone=False)
+
+    def dump_manifest(self, obs: List[AbstractObject]):
+        with self._handle(manifest.MANIFEST_PART) as fh:
+            manifest.write_manifest(fh, manifest.create_entries(obs), self._pretty_print)
 
     def dump_dot_rels(self):
         type_ = 'http://schemas.openxmlformats.org/package/2006/relationships/metadata/core-properties'
         r = [Relationship('rId1', 'docProps/core.xml', None, type_)]
         rs = Relationships(r)
         el = elementify.elementify(rs, [], None)
-        tree = etree.ElementTree(el)
-        fh = self._handle('_rels/.rels')
-        tree.write(fh, pretty_print=True, standalone=False, encoding='utf-8')
+        self._write_xml('_rels/.rels', el, standalone=False)
 
     def dump_core(self):
         from nrresqml.structures import core
         core = core.coreProperties(core.W3CDTF.now(), xsd.string('NR ResQml from NetCDF'))
         el = elementify.elementify(core, [], None)
-        tree = etree.ElementTree(el)
-        fh = self._handle('docProps/core.xml')
-        tree.write(fh, pretty_print=True, standalone=False, encoding='utf-8')
-
-
-def build_from_adaptor(adaptor: Hdf5ResQmlAdaptor, save_path: pathlib.Path, use_zip=False) -> ResQml:
+        self._write_xml('docProps/core.xml', el, standalone=False)
+
+
+# State of the serialization worker processes. Set once per process by _init_serialization_worker, so that the objects
+# are transferred to each worker only once
+_worker_state = {}
+
+
+def _init_serialization_worker(obs: List[AbstractObject], rq: ResQml, pretty_print: bool):
+    _worker_state.update(obs=obs, refs=elementify.ReferenceIndex(obs), rq=rq, pretty_print=pretty_print)
+
+
+def _serialize_object(index: int) -> Tuple[bytes, bytes]:
+    # Serializes the object with the given index and its relationships. Returns the bytes of both parts
+    obs, refs, rq = _worker_state['obs'], _worker_state['refs'], _worker_state['rq']
+    pretty_print = _worker_state['pretty_print']
+    obj = obs[index]
+    obj_bytes, rels_bytes = io.BytesIO(), io.BytesIO()
+    _write_xml(obj_bytes, elementify.elementify(obj, refs, None), None, pretty_print)
+    _write_xml(rels_bytes, elementify.elementify(rq.relationships(obj), [], None), False, pretty_print)
+    return obj_bytes.getvalue(), rels_bytes.getvalue()
+
+
+def _dump_objects(c: _Cacher, obs: List[AbstractObject], rq: ResQml, workers: int, pretty_print: bool):
+    if workers <= 1:
+        # Dump objects. The references are indexed once for all objects
+        refs = elementify.ReferenceIndex(obs)
+        for obj in obs:
+            el = elementify.elementify(obj, refs, None)
+            c.dump_epc_object(obj, el)
+
+        # Dump relationships
+        for obj in obs:
+            rs = rq.relationships(obj)
+            c.dump_relationships(obj, rs)
+        return
+
+    # Serialize in worker processes. The results are received, and written, in the same order as in the serial case.
+    # The relationship graph is computed up front, so that the workers receive it rather than recomputing it
+    rq.relationship_graph()
+    rels = []
+    chunk_size = max(1, len(obs) // (4 * workers))
+    with ProcessPoolExecutor(workers, initializer=_init_serialization_worker,
+                             initargs=(obs, rq, pretty_print)) as pool:
+        for obj, (obj_bytes, rels_bytes) in zip(obs, pool.map(_serialize_object, range(len(obs)),
+                                                              chunksize=chunk_size)):
+            c.dump_part(obj.base_name(), obj_bytes)
+            rels.append(rels_bytes)
+    for obj, rels_bytes in zip(obs, rels):
+        c.dump_part(_relationships_part_name(obj), rels_bytes)
+
+
+def build_from_adaptor(adaptor: Hdf5ResQmlAdaptor, save_path: pathlib.Path, use_zip=False,
+                       compression_level: Optional[int] = None, pretty_print: bool = True,
+                       workers: Optional[int] = None) -> ResQml:
     """
     Creates a ResQml object from the given adaptor and writes it to file. Returns the created ResQml instance for
     convenience
+
+    :param compression_level: Deflate compression level of the EPC parts. See _Cacher
+    :param pretty_print:      Indent the XML of the EPC parts
+    :param workers:           If larger than one, the objects and their relationships are serialized by this many
+                              worker processes. The output is identical to serial serialization
     """
+    # Dump datafile. This is done before creating the objects, since some object attributes (e.g. property bounds) are
+    # derived while writing the data
+    h5_fn = save_path.with_suffix('.h5').name
+    df = save_path.parent / h5_fn
+    adaptor.dump_h5_file(df)
+
     # Create the objects
     obs = adaptor.create_objects()
-    h5_fn = save_path.with_suffix('.h5').name
     rq = ResQml(obs, save_path)
     for ec in rq.objects(EpcExternalPartReference):
         rq.set_hdf5_reference(ec, h5_fn)
 
     # Set up the cacher
-    c = _Cacher(save_path.with_suffix('.epc'), use_zip)
-
-    # Dump objects
-    for obj in obs:
-        el = elementify.elementify(obj, obs, None)
-        c.dump_epc_object(obj, el)
+    with _Cacher(save_path.with_suffix('.epc'), use_zip, compression_level, pretty_print) as c:
+        # Dump objects and relationships
+        _dump_objects(c, obs, rq, workers or 1, pretty_print)
 
-    # Dump relationships
-    for obj in obs:
-        rs = rq.relationships(obj)
-        c.dump_relationships(obj, rs)
+        # Dump content types
+        c.dump_content_types(rq.content_types())
 
-    # Dump content types
-    c.dump_content_types(rq.content_types())
-
-    # Dump datafile
-    df = save_path.parent / h5_fn
-    adaptor.dump_h5_file(df)
+        # Dump manifest, which enables opening the package without parsing all objects
+        c.dump_manifest(obs)
 
-    # Dump boiler-plate files
-    c.dump_dot_rels()
-    c.dump_core()
+        # Dump boiler-plate files
+        c.dump_dot_rels()
+        c.dump_core()
 
     return rq
@@ -1,3 +1,9 @@
+from dataclasses import fields, is_dataclass
+from typing import Iterator
+
+from nrresqml.structures.energetics import AbstractObject, Hdf5Dataset
+
+
 def iterate_attributes(obj):
     for att in dir(obj):
         if att.startswith('_'):
@@ -12,3 +18,21 @@ def iterate_attributes(obj):
                 yield att, itr
         else:
             yield att, att_obj
+
+
+def hdf5_datasets(obj: AbstractObject) -> Iterator[Hdf5Dataset]:
+    """
+    Finds the HDF5 data sets that are part of obj. Other top-level objects referred by obj (such as the supporting
+    representation of a property) are not searched.
+    """
+    stack = [obj]
+    while len(stack) > 0:
+        o = stack.pop()
+        if isinstance(o, Hdf5Dataset):
+            yield o
+            continue
+        for f in fields(o):
+            value = getattr(o, f.name)
+            for v in (value if isinstance(value, list) else [value]):
+                if is_dataclass(v) and not isinstance(v, AbstractObject):
+                    stack.append(v)
@@ -4,12 +4,35 @@ from nrresqml.structures.energetics import EpcExternalPartReference, AbstractObj
 from nrresqml.structures.relationships import Relationship, TargetMode
 
 
+def _relationship_id(obj: AbstractObject) -> str:
+    # Relationship Ids must be valid xsd:IDs, which can not start with a digit like a uuid can
+    return f'_{obj.uuid}'
+
+
 def create_epc_external_part_reference_relationship(obj: EpcExternalPartReference, file_path: pathlib.Path
                                                     ) -> Relationship:
-    return Relationship(str(obj.uuid), str(file_path), TargetMode.External,
+    return Relationship(_relationship_id(obj), str(file_path), TargetMode.External,
                         'http://schemas.energistics.org/package/2012/relationships/externalResource')
 
 
-def create_general_relationship(obj: AbstractObject) -> Relationship:
-    return Relationship(str(obj.uuid), obj.base_name(), None,
-                        'http://schemas.energistics.org/package/2012/relationships/externalPartProxyToMl')
+_RELATIONSHIPS_URI = 'http://schemas.energistics.org/package/2012/relationships'
+
+
+def create_destination_object_relationship(obj: AbstractObject) -> Relationship:
+    """ Relationship from an object to an object it refers to (obj) """
+    return Relationship(_relationship_id(obj), obj.base_name(), None, f'{_RELATIONSHIPS_URI}/destinationObject')
+
+
+def create_source_object_relationship(obj: AbstractObject) -> Relationship:
+    """ Relationship from an object to an object referring to it (obj) """
+    return Relationship(_relationship_id(obj), obj.base_name(), None, f'{_RELATIONSHIPS_URI}/sourceObject')
+
+
+def create_ml_to_external_part_proxy_relationship(obj: EpcExternalPartReference) -> Relationship:
+    """ Relationship from an object to the external part proxy (obj) it refers to """
+    return Relationship(_relationship_id(obj), obj.base_name(), None, f'{_RELATIONSHIPS_URI}/mlToExternalPartProxy')
+
+
+def create_external_part_proxy_to_ml_relationship(obj: AbstractObject) -> Relationship:
+    """ Relationship from an external part proxy to an object (obj) referring to it """
+    return Relationship(_relationship_id(obj), obj.base_name(), None, f'{_RELATIONSHIPS_URI}/externalPartProxyToMl')
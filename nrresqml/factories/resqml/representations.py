@@ -2,7 +2,7 @@ from nrresqml.factories.resqml.common import create_meta_data
 from nrresqml.structures import xsd
 from nrresqml.structures.energetics import VerticalUnknownCrs, ProjectedCrsEpsgCode, AxisOrder2d, LengthUom
 from nrresqml.structures.resqml.common import LocalDepth3dCrs
-from nrresqml.structures.resqml.geometry import Point3dOffset, Point3d, Point3dLatticeArray
+from nrresqml.structures.resqml.geometry import Point3dOffset, Point3d, Point3dLatticeArray, DoubleConstantArray
 from nrresqml.structures.resqml.representations import IjkGridGeometry, KDirection, IjkGridRepresentation
 
 
@@ -28,7 +28,15 @@ def create_local_depth_3d_crs():
 
 def create_grid_representation_for_regular_grid(ni, nj, nk, dx, dy, dz) -> IjkGridRepresentation:
     crs = create_local_depth_3d_crs()
-    ds = Point3dOffset(Point3d(dx, dy, dz))
+    # One offset per axis. The lattice nodes are the cell corners, so there are ni, nj and nk spacings along the axes
+    ds = [
+        Point3dOffset(Point3d(xsd.double(dx), xsd.double(0.0), xsd.double(0.0)),
+                      DoubleConstantArray(xsd.double(1.0), xsd.positiveInteger(ni))),
+        Point3dOffset(Point3d(xsd.double(0.0), xsd.double(dy), xsd.double(0.0)),
+                      DoubleConstantArray(xsd.double(1.0), xsd.positiveInteger(nj))),
+        Point3dOffset(Point3d(xsd.double(0.0), xsd.double(0.0), xsd.double(dz)),
+                      DoubleConstantArray(xsd.double(1.0), xsd.positiveInteger(nk))),
+    ]
     arr = Point3dLatticeArray(xsd.boolean(True), Point3d(xsd.double(0.0), xsd.double(0.0), xsd.double(0.0)), ds)
     geom = IjkGridGeometry(crs, arr, KDirection.down, xsd.boolean(True))
     grid_meta = create_meta_data('Converted Delft 3D grid')
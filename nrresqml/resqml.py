@@ -1,69 +1,207 @@
 import glob
+import io
 import pathlib
-from dataclasses import is_dataclass
-from typing import List, Dict, Iterator, Optional, Type
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import is_dataclass, dataclass
+from typing import List, Dict, Iterator, Optional, Type, Any, Iterable
 from zipfile import ZipFile
 
 from lxml import etree
 
-from nrresqml.serialization.postprocessing import resolve_references
-from nrresqml.serialization import objectify
+from nrresqml.serialization.postprocessing import resolve_all_references, referenced_uuids
+from nrresqml.serialization import objectify, manifest
 from nrresqml.derivatives import utils
+from nrresqml.derivatives.hdf5pool import Hdf5FilePool
 from nrresqml.factories.resqml import relationships
 from nrresqml.structures import contenttypes
 from nrresqml.structures.energetics import AbstractObject, EpcExternalPartReference, UuidString
-from nrresqml.structures.relationships import Relationships
+from nrresqml.structures.relationships import Relationships, Relationship
 
 
 def _create_content_type_override(obj: AbstractObject) -> contenttypes.Override:
     return contenttypes.Override(obj.content_type_string(), '/' + obj.base_name())
 
 
+@dataclass
+class RelationshipGraph:
+    """
+    References between the top-level objects of a ResQml container, by uuid. Each list is ordered by first occurrence
+    and contains each object once.
+
+    :param forward: The objects that each object refers to
+    :param reverse: The objects that refer to each object
+    """
+    forward: Dict[UuidString, List[AbstractObject]]
+    reverse: Dict[UuidString, List[AbstractObject]]
+
+
 class ResQml:
     def __init__(self, objects: List[AbstractObject], root_path: pathlib.Path) -> None:
         assert root_path.suffix == '.epc'
         # Path to the root directory of the ResQml file. Primarily used to access the HDF5 data file properly
         self._root_path = root_path
         # List of all the ResQml objects (internal representations)
-        self._objects = objects
+        self._objects: List[AbstractObject] = []
         # Dict that maps uuid's to their corresponding HDF5 file. For the ResQml object to be consistent, it is
         # necessary that each object of type EpcExternalPartReference has a corresponding entry in this dict.
         self._hdf5_refs: Dict[UuidString, str] = {}
+        # Indexes of the objects by uuid, by concrete type and by the paths of the HDF5 data sets they contain. The
+        # lists of each index are in the same order as _objects
+        self._by_uuid: Dict[UuidString, AbstractObject] = {}
+        self._by_type: Dict[Type, List[AbstractObject]] = {}
+        self._by_hdf5_path: Dict[str, List[AbstractObject]] = {}
+        # Position of each object in _objects, by id. Used to merge the objects of several concrete types in order
+        self._positions: Dict[int, int] = {}
+        # Results of objects(types), by types. Cleared when objects are added
+        self._type_queries: Dict[Any, List[AbstractObject]] = {}
+        # Relationships between the objects. Computed on first use and cleared when objects are added
+        self._relationship_graph: Optional[RelationshipGraph] = None
+        # Open HDF5 files of the container. Created on first use, unless attached by the user
+        self._hdf5_pool: Optional[Hdf5FilePool] = None
+        self._owns_hdf5_pool = False
+        for obj in objects:
+            self.add_object(obj)
+
+    def add_object(self, obj: AbstractObject):
+        """ Adds obj to the container and its indexes """
+        self._positions[id(obj)] = len(self._objects)
+        self._objects.append(obj)
+        self._by_uuid.setdefault(obj.uuid, obj)
+        self._by_type.setdefault(type(obj), []).append(obj)
+        for path in {d.PathInHdfFile for d in utils.hdf5_datasets(obj)}:
+            self._by_hdf5_path.setdefault(path, []).append(obj)
+        self._type_queries.clear()
+        self._relationship_graph = None
+
+    def _contains(self, obj) -> bool:
+        # Equivalent to 'obj in self._objects', using the uuid index
+        if not isinstance(obj, AbstractObject):
+            return False
+        found = self._by_uuid.get(obj.uuid)
+        return found is not None and (found is obj or found == obj)
 
     def set_hdf5_reference(self, obj: EpcExternalPartReference, hdf5_file: str):
-        assert obj in self._objects
+        assert self._contains(obj)
         self._hdf5_refs[obj.uuid] = hdf5_file
 
     def get_full_hdf5_reference(self, obj: EpcExternalPartReference) -> str:
         return str(self._root_path.parent / self._hdf5_refs[obj.uuid])
 
+    @property
+    def hdf5_pool(self) -> Hdf5FilePool:
+        """ Pool of the open HDF5 files of the container. A default pool is created, and owned, if none is attached """
+        if self._hdf5_pool is None:
+            self._hdf5_pool = Hdf5FilePool()
+            self._owns_hdf5_pool = True
+        return self._hdf5_pool
+
+    def attach_hdf5_pool(self, pool: Hdf5FilePool):
+        """
+        Uses pool for the HDF5 files of the container. The pool may be shared between containers, and is not closed
+        when the container is closed
+        """
+        if self._owns_hdf5_pool:
+            self._hdf5_pool.close()
+        self._hdf5_pool = pool
+        self._owns_hdf5_pool = False
+
+    def close(self):
+        """ Closes the HDF5 files opened by the container """
+        if self._owns_hdf5_pool:
+            self._hdf5_pool.close()
+            self._hdf5_pool = None
+            self._owns_hdf5_pool = False
+
+    def __enter__(self) -> 'ResQml':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Open files can not be transferred to other processes. A copy opens its own files as needed
+        state = self.__dict__.copy()
+        state['_hdf5_pool'] = None
+        state['_owns_hdf5_pool'] = False
+        return state
+
+    def _query_types(self, types) -> List[AbstractObject]:
+        result = self._type_queries.get(types)
+        if result is None:
+            # Merge the objects of all concrete types that match, in the order they were added
+            result = [
+                obj
+                for concrete_type, objs in self._by_type.items() if issubclass(concrete_type, types)
+                for obj in objs
+            ]
+            result.sort(key=lambda o: self._positions[id(o)])
+            self._type_queries[types] = result
+        return result
+
     def objects(self, types: Optional[Type] = None) -> Iterator[AbstractObject]:
-        for obj in self._objects:
-            if types is None or isinstance(obj, types):
-                yield obj
+        if types is None:
+            yield from list(self._objects)
+        else:
+            yield from self._query_types(types)
 
     def find(self, uuid: UuidString) -> Optional[AbstractObject]:
-        for o in self._objects:
-            if o.uuid == uuid:
-                return o
-        return None
+        return self._by_uuid.get(uuid)
+
+    def find_by_hdf5_path(self, path: str, types: Optional[Type] = None) -> List[AbstractObject]:
+        """ Returns the objects containing a reference to the HDF5 data set with the given path, optionally by type """
+        return [
+            obj for obj in self._by_hdf5_path.get(path, [])
+            if types is None or isinstance(obj, types)
+        ]
+
+    def _referred_objects(self, obj, out: List[AbstractObject]):
+        # Appends the top-level objects referred by obj (or any of its non-top-level attributes) to out
+        for _, att_obj in utils.iterate_attributes(obj):
+            if self._contains(att_obj):
+                out.append(att_obj)
+            elif is_dataclass(att_obj):
+                # Attribute is not referenced, but may reference other objects deeper in the hierarchy
+                self._referred_objects(att_obj, out)
+
+    def relationship_graph(self) -> RelationshipGraph:
+        """ Computes the references between all objects in a single pass. The result is cached """
+        if self._relationship_graph is None:
+            forward, reverse = {}, {}
+            # Pairs of (source, target) ids that have been added, to avoid duplicate relationships
+            edges = set()
+            for obj in self._objects:
+                referred = []
+                self._referred_objects(obj, referred)
+                targets = forward.setdefault(obj.uuid, [])
+                for target in referred:
+                    if (id(obj), id(target)) in edges:
+                        continue
+                    edges.add((id(obj), id(target)))
+                    targets.append(target)
+                    reverse.setdefault(target.uuid, []).append(obj)
+            self._relationship_graph = RelationshipGraph(forward, reverse)
+        return self._relationship_graph
 
     def relationships(self, obj: AbstractObject) -> Relationships:
+        graph = self.relationship_graph()
+        referred = graph.forward.get(obj.uuid, [])
+        referring = graph.reverse.get(obj.uuid, [])
         # Check if obj is an EpcExternalPartReference, in which case it is handled in a special way
         if isinstance(obj, EpcExternalPartReference):
             fp = self._hdf5_refs[obj.uuid]
-            rels = relationships.create_epc_external_part_reference_relationship(obj, pathlib.Path(fp))
-            return Relationships([rels])
+            r = [relationships.create_epc_external_part_reference_relationship(obj, pathlib.Path(fp))]
+            r += [relationships.create_external_part_proxy_to_ml_relationship(o) for o in referring]
+            return Relationships(_with_unique_ids(r))
 
         r = []
-        for _, att_obj in utils.iterate_attributes(obj):
-            if att_obj in self._objects:
-                # Attribute is referenced, create and append relationship
-                r.append(relationships.create_general_relationship(att_obj))
-            elif is_dataclass(att_obj):
-                # Attribute is not referenced, but may reference other objects deeper in the hierarchy
-                r += self.relationships(att_obj).Relationship
-        return Relationships(r)
+        for o in referred:
+            if isinstance(o, EpcExternalPartReference):
+                r.append(relationships.create_ml_to_external_part_proxy_relationship(o))
+            else:
+                r.append(relationships.create_destination_object_relationship(o))
+        r += [relationships.create_source_object_relationship(o) for o in referring]
+        return Relationships(_with_unique_ids(r))
 
     def content_types(self) -> contenttypes.Types:
         defs = [
@@ -74,12 +212,17 @@ class ResQml:
         return contenttypes.Types(defs, overrides)
 
     @staticmethod
-    def read(cache_dir: pathlib.Path) -> 'ResQml':
+    def read(cache_dir: pathlib.Path, lazy: bool = False, workers: Optional[int] = None) -> 'ResQml':
+        """
+        Reads a ResQml package stored as a directory. If lazy, objects are parsed on demand, see LazyResQml
+        """
+        if lazy:
+            return LazyResQml(cache_dir, workers)
         # Load objects
-        fn = glob.glob(str(cache_dir) + '/*.xml')
+        fn = glob.glob(str(cache_dir) + '/obj_*.xml')
         ets = [etree.parse(f) for f in fn]
         objs = [objectify.objectify(e.getroot()) for e in ets]
-        [resolve_references(obj, objs) for obj in objs]
+        resolve_all_references(objs)
         rq = ResQml(objs, cache_dir)
 
         # Set hdf5 references
@@ -89,7 +232,12 @@ class ResQml:
         return rq
 
     @staticmethod
-    def read_zipped(epc_file: pathlib.Path) -> 'ResQml':
+    def read_zipped(epc_file: pathlib.Path, lazy: bool = False, workers: Optional[int] = None) -> 'ResQml':
+        """
+        Reads a zipped ResQml package (.epc file). If lazy, objects are parsed on demand, see LazyResQml
+        """
+        if lazy:
+            return LazyResQml(epc_file, workers)
         with ZipFile(epc_file, 'r') as z:
             ets = [
                 etree.parse(z.open(n))
@@ -97,7 +245,7 @@ class ResQml:
                 if n.endswith('.xml') and n.startswith('obj_')
             ]
             objs = [objectify.objectify(e.getroot()) for e in ets]
-            [resolve_references(obj, objs) for obj in objs]
+            resolve_all_references(objs)
             rq = ResQml(objs, epc_file)
 
             # Set hdf5 references
@@ -105,3 +253,115 @@ class ResQml:
             for epr in rq.objects(EpcExternalPartReference):
                 rq.set_hdf5_reference(epr, h5_file)
         return rq
+
+
+class LazyResQml(ResQml):
+    """
+    ResQml package where the object parts are parsed when they are accessed, rather than up front. The parts of the
+    package are listed by the manifest written by nrresqml, or by [ContentTypes].xml for other packages. Accessing an
+    object also loads the objects it refers to. Parts that are loaded together are parsed by a pool of threads.
+
+    :param epc_path: Path to the .epc file, or to the directory of an unzipped package
+    :param workers:  Number of threads parsing parts
+    """
+
+    def __init__(self, epc_path: pathlib.Path, workers: Optional[int] = None) -> None:
+        super().__init__([], epc_path)
+        self._workers = workers or 4
+        self._h5_file = epc_path.with_suffix('.h5').name  # Assumed convention, as for non-lazy reading
+        self._zip_lock = threading.Lock()
+        self._zip_file = ZipFile(epc_path, 'r') if epc_path.is_file() else None
+        try:
+            entries = manifest.read_manifest(io.BytesIO(self._read_part(manifest.MANIFEST_PART)))
+        except (KeyError, FileNotFoundError):
+            entries = manifest.read_content_types(io.BytesIO(self._read_part('[ContentTypes].xml')))
+        self._entries = entries
+        # Entries that have not been loaded yet, by uuid, in package order
+        self._unloaded: Dict[str, manifest.ManifestEntry] = {e.uuid: e for e in entries}
+        self._order = {e.uuid: i for i, e in enumerate(entries)}
+
+    def close(self):
+        if self._zip_file is not None:
+            self._zip_file.close()
+            self._zip_file = None
+        super().close()
+
+    def _read_part(self, part_name: str) -> bytes:
+        if self._zip_file is None:
+            return (self._root_path / part_name).read_bytes()
+        with self._zip_lock:
+            return self._zip_file.read(part_name)
+
+    def _parse(self, entry: manifest.ManifestEntry) -> Optional[AbstractObject]:
+        return objectify.objectify(etree.fromstring(self._read_part(entry.part_name)))
+
+    def _load(self, uuids: Iterable[str]):
+        """ Loads the objects with the given uuids, and all objects they refer to, unless already loaded """
+        pending = {u for u in uuids if u in self._unloaded}
+        loaded = []
+        while len(pending) > 0:
+            entries = [self._unloaded.pop(u) for u in sorted(pending, key=self._order.get)]
+            if len(entries) == 1:
+                objs = [self._parse(entries[0])]
+            else:
+                with ThreadPoolExecutor(self._workers) as pool:
+                    objs = list(pool.map(self._parse, entries))
+            objs = [o for o in objs if o is not None]
+            loaded += objs
+            # Objects that are referred by the new objects must be loaded as well
+            pending = {u for u in referenced_uuids(objs) if u in self._unloaded}
+        for obj in loaded:
+            self.add_object(obj)
+            if isinstance(obj, EpcExternalPartReference):
+                self.set_hdf5_reference(obj, self._h5_file)
+        if len(loaded) > 0:
+            resolve_all_references(loaded, self._objects)
+
+    def _load_types(self, types: Optional[Type]):
+        self._load(
+            e.uuid for e in list(self._unloaded.values())
+            if types is None or _is_subclass(objectify.type_by_name(e.type_name), types)
+        )
+
+    def objects(self, types: Optional[Type] = None) -> Iterator[AbstractObject]:
+        self._load_types(types)
+        return super().objects(types)
+
+    def find(self, uuid: UuidString) -> Optional[AbstractObject]:
+        self._load([uuid])
+        return super().find(uuid)
+
+    def find_by_hdf5_path(self, path: str, types: Optional[Type] = None) -> List[AbstractObject]:
+        # Objects that are known to contain the path, or that may contain it if the package has no manifest
+        self._load(
+            e.uuid for e in list(self._unloaded.values())
+            if (e.hdf5_paths is None or path in e.hdf5_paths)
+            and (types is None or _is_subclass(objectify.type_by_name(e.type_name), types))
+        )
+        return super().find_by_hdf5_path(path, types)
+
+    def relationships(self, obj: AbstractObject) -> Relationships:
+        self._load_types(None)
+        return super().relationships(obj)
+
+    def content_types(self) -> contenttypes.Types:
+        self._load_types(None)
+        return super().content_types()
+
+
+def _with_unique_ids(rels: List[Relationship]) -> List[Relationship]:
+    # An object may both refer and be referred by the same object, giving two relationships with the same target. The
+    # Ids must be unique within each relationship part
+    seen = set()
+    for rel in rels:
+        rel_id, n = rel.Id, 1
+        while rel_id in seen:
+            rel_id, n = f'{rel.Id}_{n}', n + 1
+        rel.Id = rel_id
+        seen.add(rel_id)
+    return rels
+
+
+def _is_subclass(type_: Optional[Type], types) -> bool:
+    # Unknown types are loaded regardless, since they may turn out to be of the requested type
+    return type_ is None or issubclass(type_, types)
@@ -1,16 +1,122 @@
+import dataclasses
+import inspect
+from dataclasses import dataclass
+
 from nrresqml.structures import xsd
 
 import nrresqml.factories.energetics
 import nrresqml.factories.resqml.relationships
 from nrresqml.derivatives.utils import iterate_attributes
-from typing import List, Tuple, Union, Optional
+from typing import List, Tuple, Union, Optional, Dict, FrozenSet, Type, Iterator, Any, Iterable
 
 from lxml import etree
 from nrresqml.structures.energetics import AbstractObject, DataObjectReference
 
 
+_xsi_type_uri = f'{{{xsd.xsi_uri}}}type'
+
+
+@dataclass(frozen=True)
+class _SerializationPlan:
+    """
+    Everything about the serialization of an XsdComplexType that depends on its class only. Computed once per class.
+    """
+    tag: str
+    nsmap: Dict[Optional[str], str]
+    xsi_type: str
+    main_namespace: str
+    # Names of the attributes that are serialized, in serialization order
+    attribute_names: Tuple[str, ...]
+    # Names of the attributes that are serialized as XML attributes rather than child elements
+    xml_attributes: FrozenSet[str]
+
+
+_plans: Dict[Type, _SerializationPlan] = {}
+# Namespace map and xsi type name of basic types, by class
+_basic_plans: Dict[Type, Tuple[Optional[Dict[Optional[str], str]], str]] = {}
+
+
+class ReferenceIndex:
+    """
+    Set of existing (top-level) objects that other objects refer to rather than contain. Membership is determined by
+    identity or uuid in constant time, instead of comparing (deeply) against every object of a list.
+    """
+
+    def __init__(self, objects: Iterable[AbstractObject]) -> None:
+        # Keep the objects alive, so that their ids remain unique
+        self._objects = list(objects)
+        self._ids = {id(o) for o in self._objects}
+        self._uuids = {o.uuid for o in self._objects}
+
+    def __contains__(self, obj: Any) -> bool:
+        if id(obj) in self._ids:
+            return True
+        # Objects are identified by their uuid. Copies of an object (e.g. after pickling) are therefore also found
+        return isinstance(obj, AbstractObject) and obj.uuid in self._uuids
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+
+def _reference_index(existing_refs: Union[List[AbstractObject], ReferenceIndex]) -> ReferenceIndex:
+    if isinstance(existing_refs, ReferenceIndex):
+        return existing_refs
+    return ReferenceIndex(existing_refs)
+
+
+def _attribute_names(cls: Type) -> Tuple[str, ...]:
+    # Equivalent to the names visited by iterate_attributes for instances of cls, except that attributes that are None
+    # or callable must still be skipped per instance. Methods are excluded up front.
+    names = set(dir(cls)) | {f.name for f in dataclasses.fields(cls)}
+    return tuple(
+        n for n in sorted(names)
+        if not n.startswith('_') and not inspect.isroutine(inspect.getattr_static(cls, n, None))
+    )
+
+
+def _plan(cls: Type) -> _SerializationPlan:
+    plan = _plans.get(cls)
+    if plan is None:
+        plan = _SerializationPlan(
+            tag=cls.full_type_name(),
+            nsmap=dict(cls.namespaces()),
+            xsi_type=cls.full_type_name(abbreviate_ns=True),
+            main_namespace=cls.main_namespace(abbreviate=False),
+            attribute_names=_attribute_names(cls),
+            xml_attributes=frozenset(cls.xml_attributes()),
+        )
+        _plans[cls] = plan
+    return plan
+
+
+def _basic_plan(cls: Type) -> Tuple[Optional[Dict[Optional[str], str]], str]:
+    plan = _basic_plans.get(cls)
+    if plan is None:
+        nsmap = dict(cls.namespaces()) if issubclass(cls, xsd.BasicType) else None
+        plan = (nsmap, cls.full_type_name(abbreviate_ns=True))
+        _basic_plans[cls] = plan
+    return plan
+
+
+def _iterate_planned_attributes(obj: xsd.XsdComplexType, plan: _SerializationPlan) -> Iterator[Tuple[str, Any]]:
+    for att in plan.attribute_names:
+        att_obj = getattr(obj, att)
+        if att_obj is None:
+            continue
+        if callable(att_obj):
+            continue
+        if isinstance(att_obj, list):
+            for itr in att_obj:
+                yield att, itr
+        else:
+            yield att, att_obj
+
+
+_no_refs = ReferenceIndex([])
+
+
 def _data_object_reference_to_element(obj: DataObjectReference, tag: str) -> etree.Element:
-    return elementify(obj, [], tag)
+    return elementify(obj, _no_refs, tag)
 
 
 def _create_data_object_reference(att_name: str, obj: AbstractObject, parent_ns: str) -> etree.Element:
@@ -20,7 +126,7 @@ def _create_data_object_reference(att_name: str, obj: AbstractObject, parent_ns:
 
 
 def _append_xsi_type(el: etree.Element, obj: Union[xsd.BasicType, xsd.XsdComplexType]):
-    el.attrib[f'{{{xsd.xsi_uri}}}type'] = obj.full_type_name(abbreviate_ns=True)
+    el.attrib[_xsi_type_uri] = obj.full_type_name(abbreviate_ns=True)
 
 
 def _full_tag(ns, att):
@@ -30,16 +136,13 @@ def _full_tag(ns, att):
 
 def _objectify_basic_attribute(att_name, att_obj, parent_ns) -> etree.Element:
     full_tag = _full_tag(parent_ns, att_name)
-    if isinstance(att_obj, xsd.BasicType):
-        ns = dict(att_obj.namespaces())
-        el = etree.Element(full_tag, nsmap=ns)
-    else:
-        el = etree.Element(full_tag)
+    nsmap, xsi_type = _basic_plan(type(att_obj))
+    el = etree.Element(full_tag, nsmap=nsmap)
     if isinstance(att_obj, xsd.BasicEnum):
         el.text = att_obj.name
     else:
         el.text = str(att_obj)
-    _append_xsi_type(el, att_obj)
+    el.attrib[_xsi_type_uri] = xsi_type
     return el
 
 
@@ -47,8 +150,38 @@ def _attributify(att_name, att_obj) -> Tuple[str, str]:
     return att_name, str(att_obj)
 
 
-def elementify(obj: xsd.XsdComplexType, existing_refs: List[AbstractObject], tag: Optional[str]) -> etree.Element:
-    # el = etree.Element(obj.full_type_name(), nsmap=dict(obj.namespaces()))
+def elementify(obj: xsd.XsdComplexType, existing_refs: Union[List[AbstractObject], ReferenceIndex],
+               tag: Optional[str]) -> etree.Element:
+    """
+    Converts obj to an XML element. Attributes that are among existing_refs are written as references, all other
+    attributes are written recursively. When serializing many objects against the same references, pass a
+    ReferenceIndex to avoid re-indexing the references for every object.
+    """
+    existing_refs = _reference_index(existing_refs)
+    if not dataclasses.is_dataclass(obj):
+        return _elementify_generic(obj, existing_refs, tag)
+    plan = _plan(type(obj))
+    el = etree.Element(tag or plan.tag, nsmap=plan.nsmap)
+    for att, att_obj in _iterate_planned_attributes(obj, plan):
+        if att in plan.xml_attributes:
+            key, value = _attributify(att, att_obj)
+            el.attrib[key] = value
+        elif isinstance(att_obj, xsd.XsdComplexType) and att_obj not in existing_refs:
+            # Object is complex and needs to be recursively objectified
+            el.append(elementify(att_obj, existing_refs, att))
+        elif att_obj in existing_refs:
+            # Object should only be addressed by reference since it already exists
+            el.append(_create_data_object_reference(att, att_obj, plan.main_namespace))
+        else:
+            # Object is simple and can be translated without recursion
+            el.append(_objectify_basic_attribute(att, att_obj, plan.main_namespace))
+    # Inject the xsi type name
+    el.attrib[_xsi_type_uri] = plan.xsi_type
+    return el
+
+
+def _elementify_generic(obj: xsd.XsdComplexType, existing_refs: ReferenceIndex, tag: Optional[str]) -> etree.Element:
+    # Serialization of complex types that are not dataclasses, for which no plan can be made
     tag = tag or obj.full_type_name()
     el = etree.Element(tag, nsmap=dict(obj.namespaces()))
     for att, att_obj in iterate_attributes(obj):
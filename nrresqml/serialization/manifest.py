@@ -0,0 +1,78 @@
+import re
+from dataclasses import dataclass, field
+from typing import List, IO, Optional
+
+from lxml import etree
+
+from nrresqml.derivatives import utils
+from nrresqml.structures.energetics import AbstractObject
+
+
+# Name of the manifest part of EPC files written by nrresqml. The manifest lists the object parts of the package, so
+# that the package can be opened without parsing every part
+MANIFEST_PART = 'docProps/nrresqml-manifest.xml'
+_MANIFEST_NS = 'urn:nrresqml:manifest'
+_CONTENT_TYPES_NS = 'http://schemas.openxmlformats.org/package/2006/content-types'
+_OBJECT_PART_REGEX = re.compile(r'^/?obj_(?P<type>\w+?)_(?P<uuid>[0-9a-fA-F]{8}-[0-9a-fA-F-]{27})\.xml$')
+
+
+@dataclass
+class ManifestEntry:
+    """
+    Description of a single object part of an EPC package
+
+    :param part_name:   Name of the part within the package
+    :param uuid:        uuid of the object
+    :param type_name:   Name of the object type, e.g. ContinuousProperty
+    :param hdf5_paths:  Paths of the HDF5 data sets that the object contains. None if unknown
+    """
+    part_name: str
+    uuid: str
+    type_name: str
+    hdf5_paths: Optional[List[str]] = field(default=None)
+
+
+def create_entries(objects: List[AbstractObject]) -> List[ManifestEntry]:
+    return [
+        ManifestEntry(
+            obj.base_name(), str(obj.uuid), obj.type_name(), sorted({str(d.PathInHdfFile)
+                                                                     for d in utils.hdf5_datasets(obj)})
+        )
+        for obj in objects
+    ]
+
+
+def write_manifest(fh: IO[bytes], entries: List[ManifestEntry], pretty_print: bool = True):
+    root = etree.Element(f'{{{_MANIFEST_NS}}}Manifest', nsmap={None: _MANIFEST_NS})
+    for e in entries:
+        part = etree.SubElement(root, f'{{{_MANIFEST_NS}}}Part', name=e.part_name, uuid=e.uuid, type=e.type_name)
+        for p in e.hdf5_paths or []:
+            etree.SubElement(part, f'{{{_MANIFEST_NS}}}Hdf5Dataset', path=p)
+    with etree.xmlfile(fh, encoding='UTF-8') as xf:
+        xf.write_declaration(standalone=False)
+        xf.write(root, pretty_print=pretty_print)
+
+
+def read_manifest(fh: IO[bytes]) -> List[ManifestEntry]:
+    root = etree.parse(fh).getroot()
+    return [
+        ManifestEntry(
+            part.get('name'), part.get('uuid'), part.get('type'),
+            [ds.get('path') for ds in part.iterchildren(f'{{{_MANIFEST_NS}}}Hdf5Dataset')]
+        )
+        for part in root.iterchildren(f'{{{_MANIFEST_NS}}}Part')
+    ]
+
+
+def read_content_types(fh: IO[bytes]) -> List[ManifestEntry]:
+    """
+    Derives the manifest entries from [ContentTypes].xml, for packages without a manifest. The type and uuid of each
+    object part are given by the part name. The HDF5 data sets of the objects are unknown.
+    """
+    root = etree.parse(fh).getroot()
+    entries = []
+    for override in root.iterchildren(f'{{{_CONTENT_TYPES_NS}}}Override'):
+        m = _OBJECT_PART_REGEX.match(override.get('PartName', ''))
+        if m is not None:
+            entries.append(ManifestEntry(override.get('PartName').lstrip('/'), m.group('uuid'), m.group('type')))
+    return entries
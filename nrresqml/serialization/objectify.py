@@ -1,3 +1,4 @@
+import functools
 import typing
 import inspect
 from typing import Type, Optional
@@ -36,7 +37,11 @@ class _ElementExtractValueError(Exception):
     pass
 
 
-def _lookup_xsi_type(xsi_name: str) -> Optional[Type]:
+@functools.lru_cache(maxsize=None)
+def _xsi_registry() -> typing.Dict[str, Type]:
+    # Maps both the prefixed (e.g. resqml2:IjkGridRepresentation) and the Clark notation names of each class to the
+    # class. Built once, on first use. If a name is shared by several classes, the first class in _packages order wins
+    registry = {}
     for module, clazzes in _classes.items():
         for clazz, type_ in clazzes:
             if type_.__module__ != module.__name__:
@@ -46,8 +51,21 @@ def _lookup_xsi_type(xsi_name: str) -> Optional[Type]:
                       f'{{{type_.main_namespace(abbreviate=False)}}}']
             except (AttributeError, NotImplementedError):
                 ns = ['']
-            if any(xsi_name == f'{n}{clazz}' for n in ns):
-                return type_
+            for n in ns:
+                registry.setdefault(f'{n}{clazz}', type_)
+    return registry
+
+
+def _lookup_xsi_type(xsi_name: str) -> Optional[Type]:
+    return _xsi_registry().get(xsi_name)
+
+
+@functools.lru_cache(maxsize=None)
+def type_by_name(type_name: str) -> Optional[Type]:
+    """ Looks up a class by its type name (i.e. without namespace), such as IjkGridRepresentation """
+    for type_ in _xsi_registry().values():
+        if type_.__name__ == type_name:
+            return type_
     return None
 
 
@@ -59,8 +77,13 @@ def _determine_type(el: etree.Element) -> Optional[Type]:
         return _lookup_xsi_type(t)
 
 
+@functools.lru_cache(maxsize=None)
+def _type_hints(type_: Type) -> typing.Tuple[typing.Tuple[str, typing.Any], ...]:
+    return tuple(typing.get_type_hints(type_).items())
+
+
 def _iterate_attributes(type_: Type):
-    for an, at in typing.get_type_hints(type_).items():
+    for an, at in _type_hints(type_):
         yield an
 
 
@@ -111,13 +134,12 @@ def _extract_values(el: etree.Element, att_name: str, att_type: Type
         return out[0]
 
 
-def _iterate(el: etree.Element):
+def _iterate(el: etree.Element, type_: Type):
     for key, value in el.attrib.items():
         if key == _xsi_type_uri:
             continue
         yield key, value
-    type_ = _determine_type(el)
-    for an, at in typing.get_type_hints(type_).items():
+    for an, at in _type_hints(type_):
         try:
             yield an, _extract_values(el, an, at)
         except _ElementExtractValueError as e:
@@ -125,10 +147,9 @@ def _iterate(el: etree.Element):
 
 
 def objectify(el: etree.Element):
-    # TODO: avoid calling determine_type twice
     type_ = _determine_type(el)
     if type_ is None:
         reporting.error(f'Failed to determine type for XML tag {el.tag}')
         return
-    ctor_dict = dict(_iterate(el))
+    ctor_dict = dict(_iterate(el, type_))
     return type_(**ctor_dict)
@@ -1,24 +1,102 @@
+import dataclasses
+import functools
 from dataclasses import is_dataclass
-from typing import List
-from nrresqml.structures.energetics import AbstractObject, DataObjectReference
+from typing import List, Optional, Dict, Set, Tuple
+from nrresqml.structures.energetics import AbstractObject, DataObjectReference, UuidString
 from nrresqml import reporting
 
 
-def resolve_references(obj, refs: List[AbstractObject]):
-    for an in dir(obj):
-        if an.startswith('_'):
+@functools.lru_cache(maxsize=None)
+def _field_names(type_) -> Tuple[str, ...]:
+    return tuple(f.name for f in dataclasses.fields(type_) if not f.name.startswith('_'))
+
+
+def _attribute_names(obj) -> Tuple[str, ...]:
+    if is_dataclass(obj):
+        return _field_names(type(obj))
+    return tuple(an for an in dir(obj) if not an.startswith('_') and not callable(getattr(obj, an)))
+
+
+def _index_uuids(refs: List[AbstractObject]) -> Tuple[Dict[UuidString, AbstractObject], Set[UuidString]]:
+    by_uuid, duplicates = {}, set()
+    for r in refs:
+        if r is None:
             continue
-        ao = getattr(obj, an)
-        if isinstance(ao, DataObjectReference):
-            ds = [r for r in refs if r.uuid == ao.UUID]
-            if len(ds) == 0:
-                reporting.error(f'A DataObjectReference is referring a non-existing object ({ao.UUID})')
-                continue
-            if len(ds) > 1:
-                reporting.error(f'A DataObjectReference is referring a duplicate uuid ({ao.UUID})')
-                continue
-            d = ds[0]
-            setattr(obj, an, d)
-            resolve_references(d, refs)
-        elif is_dataclass(ao):
-            resolve_references(ao, refs)
+        if r.uuid in by_uuid:
+            duplicates.add(r.uuid)
+        by_uuid[r.uuid] = r
+    return by_uuid, duplicates
+
+
+def resolve_all_references(objects: List[AbstractObject], refs: Optional[List[AbstractObject]] = None):
+    """
+    Replaces every DataObjectReference in the object graphs of objects, including references inside lists, with the
+    object it refers to. The referred objects are looked up among refs, which defaults to objects. The graph is
+    resolved in a single pass, visiting each object once. References to missing or duplicate uuids are left in place
+    and reported once all objects have been visited.
+    """
+    by_uuid, duplicates = _index_uuids(objects if refs is None else refs)
+    missing, duplicated = set(), set()
+    visited = set()
+    stack = [o for o in objects if o is not None]
+
+    def _resolve(value):
+        if isinstance(value, DataObjectReference):
+            if value.UUID in duplicates:
+                duplicated.add(value.UUID)
+                return value
+            target = by_uuid.get(value.UUID)
+            if target is None:
+                missing.add(value.UUID)
+                return value
+            stack.append(target)
+            return target
+        if is_dataclass(value):
+            stack.append(value)
+        return value
+
+    while len(stack) > 0:
+        obj = stack.pop()
+        if id(obj) in visited:
+            continue
+        visited.add(id(obj))
+        for an in _attribute_names(obj):
+            ao = getattr(obj, an)
+            if isinstance(ao, list):
+                for i, item in enumerate(ao):
+                    ao[i] = _resolve(item)
+            else:
+                resolved = _resolve(ao)
+                if resolved is not ao:
+                    setattr(obj, an, resolved)
+
+    if len(missing) > 0:
+        reporting.error(f'DataObjectReferences are referring {len(missing)} non-existing object(s): '
+                        + ', '.join(sorted(missing)))
+    if len(duplicated) > 0:
+        reporting.error(f'DataObjectReferences are referring {len(duplicated)} duplicate uuid(s): '
+                        + ', '.join(sorted(duplicated)))
+
+
+def referenced_uuids(objects: List[AbstractObject]) -> Set[UuidString]:
+    """ Finds the uuids of all unresolved DataObjectReferences in the object graphs of objects """
+    uuids = set()
+    visited = set()
+    stack = list(objects)
+    while len(stack) > 0:
+        obj = stack.pop()
+        if id(obj) in visited:
+            continue
+        visited.add(id(obj))
+        for an in _attribute_names(obj):
+            ao = getattr(obj, an)
+            for v in (ao if isinstance(ao, list) else [ao]):
+                if isinstance(v, DataObjectReference):
+                    uuids.add(v.UUID)
+                elif is_dataclass(v):
+                    stack.append(v)
+    return uuids
+
+
+def resolve_references(obj, refs: List[AbstractObject]):
+    resolve_all_references([obj], refs)
@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, List
 
 from nrresqml.structures.energetics import Hdf5Dataset
 from nrresqml.structures import xsd
@@ -14,11 +14,6 @@ class Point3d(ResqmlComplexType):
     Coordinate3: xsd.double
 
 
-@dataclass
-class Point3dOffset(ResqmlComplexType):
-    Offset: Point3d
-
-
 """ Abstract Value Array """
 
 
@@ -48,6 +43,18 @@ class DoubleHdf5Array(AbstractDoubleArray):
     Values: Hdf5Dataset
 
 
+@dataclass
+class DoubleConstantArray(AbstractDoubleArray):
+    Value: xsd.double
+    Count: xsd.positiveInteger
+
+
+@dataclass
+class Point3dOffset(ResqmlComplexType):
+    Offset: Point3d
+    Spacing: AbstractDoubleArray
+
+
 """ AbstractPoint3dArray """
 
 
@@ -60,7 +67,7 @@ class AbstractPoint3dArray(ResqmlComplexType):
 class Point3dLatticeArray(AbstractPoint3dArray):
     AllDimensionsAreOrthogonal: Optional[xsd.boolean]
     Origin: Point3d
-    Offset: Point3dOffset
+    Offset: List[Point3dOffset]
 
 
 @dataclass
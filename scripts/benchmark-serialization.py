@@ -0,0 +1,51 @@
+import argparse
+import os
+import sys
+from time import perf_counter
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # nrresqml, in case it is not installed
+from lxml import etree
+from nrresqml.factories.energetics import create_hdf5_reference
+from nrresqml.factories.resqml.properties import create_continuous_property
+from nrresqml.factories.resqml.representations import create_grid_representation_for_regular_grid
+from nrresqml.serialization import elementify
+from nrresqml.structures import xsd
+
+
+# Times the conversion of ResQml objects to XML by elementify, i.e. the per-object serialization cost of writing an EPC
+# package. The objects are a regular grid, its CRS, an HDF5 reference and a number of continuous properties, so no
+# input files are needed. Run the script at two commits to compare them.
+parser = argparse.ArgumentParser(description='Benchmark the serialization of ResQml objects to XML')
+parser.add_argument(
+    '--properties', metavar='<n>', type=int, default=2000,
+    help='Number of continuous properties serialized in addition to the grid, its CRS and the HDF5 reference'
+)
+parser.add_argument(
+    '--refs', choices=('few', 'all'), nargs='*', default=('few', 'all'),
+    help='Existing references: the first 8 objects (few), isolating the per-element cost, or all objects (all), '
+         'including the reference look-up'
+)
+parser.add_argument(
+    '--repeat', metavar='<n>', type=int, default=3,
+    help='Number of repetitions. The fastest is reported'
+)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    grid = create_grid_representation_for_regular_grid(
+        xsd.positiveInteger(200), xsd.positiveInteger(100), xsd.positiveInteger(50),
+        xsd.double(50.0), xsd.double(25.0), xsd.double(1.0)
+    )
+    ref = create_hdf5_reference()
+    objects = [grid, grid.Geometry.LocalCrs, ref] + [
+        create_continuous_property(f'Property {i}', f'property_{i}', 0.0, 1.0, grid, ref)
+        for i in range(args.properties)
+    ]
+    for refs in args.refs:
+        existing_refs = objects[:8] if refs == 'few' else objects
+        timings = []
+        for _ in range(args.repeat):
+            t0 = perf_counter()
+            for obj in objects:
+                etree.tostring(elementify.elementify(obj, existing_refs, None))
+            timings.append(perf_counter() - t0)
+        print(f'{len(objects)} objects, {len(existing_refs)} existing refs: {min(timings):.2f} s')
@@ -0,0 +1,53 @@
+import argparse
+import os
+import pathlib
+import sys
+from time import perf_counter
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # nrresqml, in case it is not installed
+from nrresqml.resqml import ResQml
+from nrresqml.derivatives import gridexport
+
+
+_EXPORTERS = {
+    'grdecl': gridexport.export_grdecl,
+    'roff': gridexport.export_roff,
+}
+
+
+parser = argparse.ArgumentParser(description='Export the grid of a ResQml database to GRDECL or ROFF')
+parser.add_argument('epc_file', metavar='<epc-file>', help='ResQml database (.epc) with its .h5 file next to it')
+parser.add_argument('output_file', metavar='<output-file>', help='Destination file of the exported grid')
+parser.add_argument(
+    '--format', choices=tuple(_EXPORTERS), default=None,
+    help='Output format. Inferred from the extension of the output file if not provided'
+)
+parser.add_argument(
+    '--properties', metavar='<name>', nargs='*', default=None,
+    help='Names of the properties to export. All properties of the grid are exported if not provided'
+)
+parser.add_argument(
+    '--keywords', metavar='<name>=<keyword>', nargs='*', default=(),
+    help='GRDECL keywords of properties. Other properties are named by their truncated data set name'
+)
+parser.add_argument(
+    '--block-size', metavar='<layers>', type=int, default=16,
+    help='Number of K layers read and written at a time. Memory usage is proportional to the block size'
+)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    fmt = args.format
+    if fmt is None:
+        fmt = os.path.splitext(args.output_file)[1].lstrip('.').lower()
+        if fmt not in _EXPORTERS:
+            parser.error(f'Cannot infer the output format from "{args.output_file}", use --format')
+    if fmt != 'grdecl' and len(args.keywords) > 0:
+        parser.error('--keywords is only supported by the GRDECL format')
+    if any('=' not in k for k in args.keywords):
+        parser.error('Keywords must be given as <name>=<keyword>')
+    options = {'keywords': dict(k.split('=', 1) for k in args.keywords)} if fmt == 'grdecl' else {}
+    t0 = perf_counter()
+    with ResQml.read_zipped(pathlib.Path(args.epc_file), lazy=True) as rq:
+        _EXPORTERS[fmt](rq, args.output_file, properties=args.properties, block_size=args.block_size, **options)
+    t1 = perf_counter()
+    print(f'Export completed in {t1 - t0} s')